@@ -1,15 +1,29 @@
 import os
 from flask import Flask, jsonify, g
-from flask_sqlalchemy import SQLAlchemy
 from .decorators import json, no_cache
 from flask_cors import CORS, cross_origin
-from flask_limit import RateLimiter
+from .cache import ResponseCache
+from .database import Database
+from .images import ImageStore
+from .search import SearchIndex
+from .instrumentation import QueryStats
+from .events import EventStream
+from .ratelimit import RateLimiter
+from .passwords import PasswordHasher
+from .encoding import Encoder
 
 
 
 
-db = SQLAlchemy()
+db = Database()
 limiter = RateLimiter()
+response_cache = ResponseCache()
+image_store = ImageStore()
+search_index = SearchIndex()
+query_stats = QueryStats()
+event_stream = EventStream()
+hasher = PasswordHasher()
+encoder = Encoder()
 
 
 def create_app(config_name):
@@ -23,12 +37,21 @@ def create_app(config_name):
     # initialize extensions
     db.init_app(app)
     limiter.init_app(app)
+    response_cache.init_app(app)
+    image_store.init_app(app)
+    event_stream.init_app(app)
+    hasher.init_app(app)
+    encoder.init_app(app)
     CORS(app)
 
     # register blueprints
     from .api import api as api_blueprint
     app.register_blueprint(api_blueprint, url_prefix='/api')
 
+    # attach the full-text search index to the searchable models
+    from .models import User, Feed
+    search_index.init_app(app, [User, Feed])
+
     # register an after request handler
     @app.after_request
     def after_request(rv):
@@ -36,4 +59,8 @@ def create_app(config_name):
         rv.headers.extend(headers)
         return rv
 
+    # after request handlers run in reverse order, so this one is
+    # initialized last for its headers to be picked up by the handler above
+    query_stats.init_app(app)
+
     return app
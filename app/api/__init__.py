@@ -7,10 +7,9 @@ api = Blueprint('api', __name__)
 
 
 @api.before_request
-@limiter.rate_limit(limit=20, period=15)
 def before_request():
     """All routes in this blueprint rate limited."""
-    pass
+    return limiter.check()
 
 
 @api.after_request
@@ -19,4 +18,4 @@ def after_request(rv):
     return rv
 
 
-from . import user, feed, message, errors
+from . import user, feed, message, stream, errors
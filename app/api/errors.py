@@ -1,5 +1,6 @@
 from flask import jsonify
 from ..exceptions import ValidationError
+from ..passwords import HasherBusy
 from . import api
 
 
@@ -11,6 +12,15 @@ def bad_request(e):
     return response
 
 
+@api.app_errorhandler(HasherBusy)  # also raised during authentication
+def service_unavailable(e):
+    response = jsonify({'status': 503, 'error': 'service unavailable',
+                        'message': e.args[0]})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+
 @api.app_errorhandler(403)  # this has to be an app-wide handler
 def not_found(e):
     response = jsonify({'status': 401, 'error': 'Unauthorized',
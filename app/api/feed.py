@@ -1,14 +1,15 @@
-from flask import request, g, jsonify, url_for
+from flask import request, g, url_for
+from ..encoding import jsonify
 from . import api
-from .. import db, create_app
+from .. import db, image_store, search_index
 from ..models import Feed, Comment, User, Like
-from ..decorators import json, paginate
-from werkzeug.utils import secure_filename
+from ..decorators import json, paginate, cached, versioned_etag, read_only
+from ..cache import invalidate
+from ..events import publish
+from sqlalchemy.exc import IntegrityError
 from ..utils import allowed_file
 from ..auth import auth_token
-from datetime import datetime
 
-import os
 from flask import url_for, current_app
 
 
@@ -20,38 +21,87 @@ def get_author_image(id):
     return url_for('static', filename='images/users/'+user.image, _external=True)
 
 @api.route('/feeds', methods=['GET'])
-@json
-@paginate('feeds')
 @auth_token.login_required
+@read_only
+@cached('feeds', 'users')
+@versioned_etag(Feed.get_collection_version)
+@json
+@paginate('feeds', keyset=(Feed.timestamp, Feed.id))
 def get_feeds():
     return Feed.query.order_by(Feed.timestamp.desc())
 
+@api.route('/user/<int:id>/feeds', methods=['GET'])
+@auth_token.login_required
+@read_only
+@cached('feeds', 'users')
+@versioned_etag(Feed.get_author_version)
+@json
+@paginate('feeds', keyset=(Feed.timestamp, Feed.id),
+          keyset_default=True)
+def get_user_feeds(id):
+    return Feed.query.filter_by(author_id=id).order_by(Feed.timestamp.desc())
+
+@api.route('/feeds/search', methods=['GET'])
+@auth_token.login_required
+@read_only
+@json
+def search_feeds():
+    query = request.args.get('q', '')
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 25, type=int), 1), 25)
+    ids, total = search_index.search(Feed, query, page=page, per_page=per_page)
+
+    # load the feeds on this page and export them in ranked order
+    feeds = {}
+    if ids:
+        feeds = dict((feed.id, feed) for feed in
+                     Feed.query.filter(Feed.id.in_(ids)))
+    results = Feed.export_collection([feeds[id] for id in ids if id in feeds])
+
+    # build the pagination metadata to include in the response
+    pages = {'page': page, 'per_page': per_page, 'total': total,
+             'pages': (total + per_page - 1) // per_page,
+             'prev_url': None, 'next_url': None}
+    if page > 1:
+        pages['prev_url'] = url_for('api.search_feeds', q=query,
+                                    page=page - 1, per_page=per_page,
+                                    _external=True)
+    if page < pages['pages']:
+        pages['next_url'] = url_for('api.search_feeds', q=query,
+                                    page=page + 1, per_page=per_page,
+                                    _external=True)
+    return {'feeds': results, 'pages': pages}
+
+
 @api.route('/feed/<int:id>', methods=['GET'])
 @auth_token.login_required
+@read_only
+@cached('feed:{id}', 'users')
+@versioned_etag(Feed.get_version)
 def get_feed(id):
     feed = Feed.query.get_or_404(id)
-    return jsonify({'feed': feed.export_data(), 'comments': [comment.export_data() for comment in feed.comments]})
+    return jsonify({'feed': feed.export_data(),
+                    'comments': Comment.export_collection(feed.comments.all())})
 
 
 @api.route('/comments/<int:id>', methods=['GET'])
 @auth_token.login_required
+@read_only
+@versioned_etag(Feed.get_version)
 def get_feed_comments(id):
     feed = Feed.query.get_or_404(id)
-    return jsonify([comment.export_data() for comment in feed.comments])
+    return jsonify(Comment.export_collection(feed.comments.all()))
 
 @api.route('/feed', methods=['POST'])
 @json
 @auth_token.login_required
 def new_feed():
-    app = create_app('production')
     feed = Feed()
     if not request.json:
         if request.files['image'] is not None:
             image = request.files['image']
             if image and allowed_file(image.filename):
-                imagename = "{:%I%M%S%f%d%m%Y}".format(datetime.now()) + secure_filename(image.filename)
-                image.save(os.path.join(app.config['FEED_UPLOAD_FOLDER'], imagename))
-                feed.image = imagename
+                feed.image = image_store.save(image, current_app.config['FEED_UPLOAD_FOLDER'])
                 feed.title = request.form['title']
                 feed.body = request.form['body']
     else:
@@ -59,6 +109,7 @@ def new_feed():
     feed.author = g.user
     db.session.add(feed)
     db.session.commit()
+    invalidate('feeds')
     return {}, 201, {'Message': 'Feed Created Successfully'}
 
 
@@ -70,8 +121,13 @@ def new_feed_comment(id):
     comment.import_data(request.json)
     comment.feed = feed
     comment.author = g.user
+    feed.comment_count = Feed.comment_count + 1
     db.session.add(comment)
     db.session.commit()
+    invalidate('feeds', 'feed:%d' % id)
+    if feed.author_id != g.user.id:
+        publish([feed.author_id], 'new_comment', id=comment.id, feed_id=id,
+                author_id=g.user.id, url=feed.get_url())
     return jsonify({'comment': comment.export_data()})
 
 
@@ -82,23 +138,28 @@ def edit_feed(id):
     feed = Feed.query.get_or_404(id)
     image = request.files['image']
     if image and allowed_file(image.filename):
-        imagename = "{:%I%M%S%f%d%m%Y}".format(datetime.now()) + secure_filename(image.filename)
-        image.save(os.path.join(app.config['UPLOAD_FOLDER'], imagename))
-        feed.image = imagename
+        feed.image = image_store.save(image, current_app.config['FEED_UPLOAD_FOLDER'])
     feed.title = request.form['title']
     feed.body = request.form['body']
     db.session.add(feed)
     db.session.commit()
+    invalidate('feeds', 'feed:%d' % id)
     return {}
 
 @api.route('/like/<int:id>')
 @auth_token.login_required
 def like(id):
     feed = Feed.query.get_or_404(id)
-    for like in feed.likes:
-        if g.user == like.liker:
-            return 'You are not allowed to like again'
+    if Like.query.filter_by(user_id=g.user.id, feed_id=feed.id).first():
+        return 'You are not allowed to like again'
     vote = Like(feed=feed, liker=g.user)
+    feed.like_count = Feed.like_count + 1
     db.session.add(vote)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # a concurrent request from the same user got there first
+        db.session.rollback()
+        return 'You are not allowed to like again'
+    invalidate('feeds', 'feed:%d' % id)
     return 'Liked'
@@ -1,22 +1,31 @@
-from flask import request, jsonify, g, abort
+from flask import request, g, abort, url_for
+from ..encoding import jsonify
 from . import api
 from .. import db
-from ..models import Message, Reply
-from ..decorators import json, paginate
+from ..models import Message, MessageCounter, Reply, load_users
+from ..decorators import json, paginate, cached, versioned_etag, read_only
+from ..cache import invalidate
+from ..events import publish
 from ..auth import auth_token
 
 @api.route('/inbox', methods=['GET'])
-@json
-@paginate('messages')
 @auth_token.login_required
+@read_only
+@cached('inbox:{user}')
+@versioned_etag(lambda: Message.get_inbox_version(g.user.id))
+@json
+@paginate('messages', keyset=(Message.created_on, Message.id))
 def get_inbox():
     return Message.query.filter_by(receiver_id=g.user.id)
 
 
 @api.route('/outbox', methods=['GET'])
-@json
-@paginate('messages')
 @auth_token.login_required
+@read_only
+@cached('outbox:{user}')
+@versioned_etag(lambda: Message.get_outbox_version(g.user.id))
+@json
+@paginate('messages', keyset=(Message.created_on, Message.id))
 def get_outbox():
     return Message.query.filter_by(sender_id=g.user.id)
 
@@ -24,44 +33,74 @@ def get_outbox():
 @api.route('/total', methods=['GET'])
 @auth_token.login_required
 def get_total():
-    outboxes = Message.query.filter_by(sender_id=g.user.id).count()
-    inboxes = Message.query.filter_by(receiver_id=g.user.id).count()
-    total = outboxes + inboxes
-    return jsonify({'total': total})
+    counter = MessageCounter.get(g.user.id)
+    return jsonify({'total': counter.received + counter.sent})
+
+
+@api.route('/unread', methods=['GET'])
+@auth_token.login_required
+def get_unread():
+    counter = MessageCounter.get(g.user.id)
+    return jsonify({'unread': counter.unread, 'received': counter.received,
+                    'sent': counter.sent,
+                    'total': counter.received + counter.sent})
 
 @api.route('/get_replies/<int:id>', methods=['GET'])
 @auth_token.login_required
+@read_only
+@versioned_etag(lambda id: Message.get_version(id, g.user.id))
 def get_replies(id):
     message = Message.query.get_or_404(id)
     if not message.is_mine():
         abort(401)
-    return jsonify([reply.export_data() for reply in message.replies])
+    return jsonify(Reply.export_collection(message.replies.all()))
 
 
 @api.route('/message/<int:id>', methods=['GET'])
 @auth_token.login_required
+@versioned_etag(lambda id: Message.get_version(id, g.user.id))
 def get_message(id):
     message = Message.query.get_or_404(id)
     if not message.is_mine():
         abort(403)
-    message.read = 1
-    db.session.add(message)
-    db.session.commit()
-    return jsonify({'message': message.export_data(), 'replies': [reply.export_data() for reply in message.replies]})
+    if not message.read:
+        # flipped with a conditional update, so that only one of several
+        # concurrent reads of the message counts it as read
+        MessageCounter.ensure(message.receiver_id)
+        if Message.query.filter(Message.id == id, db.or_(
+                Message.read == False, Message.read == None)) \
+                .update({'read': True}, synchronize_session=False):
+            MessageCounter.update(message.receiver_id, unread=-1)
+        db.session.commit()
+    invalidate('inbox:%d' % message.receiver_id,
+               'outbox:%d' % message.sender_id)
+    replies = message.replies.all()
+    users = load_users([message.sender_id, message.receiver_id] +
+                       [reply.author_id for reply in replies])
+    return jsonify({'message': message.export_data(users),
+                    'replies': [reply.export_data(users) for reply in replies]})
 
 
 @api.route('/reply/<int:id>', methods=['POST'])
 @auth_token.login_required
 def new_reply(id):
     message = Message.query.get_or_404(id)
-    message.read = 0
     reply = Reply()
     reply.import_data(request.json)
     reply.message = message
     reply.author = g.user
-    db.session.add(message)
+    MessageCounter.ensure(message.receiver_id)
+    if Message.query.filter_by(id=id, read=True) \
+            .update({'read': False}, synchronize_session=False):
+        MessageCounter.update(message.receiver_id, unread=1)
     db.session.add(reply)
     db.session.commit()
+    invalidate('inbox:%d' % message.receiver_id,
+               'outbox:%d' % message.sender_id)
+    publish([user_id for user_id in (message.sender_id, message.receiver_id)
+             if user_id != g.user.id], 'new_reply', id=reply.id,
+            message_id=message.id, author_id=g.user.id,
+            url=url_for('api.get_replies', id=message.id, _external=True))
     return jsonify({'reply': reply.export_data()})
 
 @api.route('/message', methods=['POST'])
@@ -71,8 +110,15 @@ def new_message():
     message = Message()
     message.import_data(request.json)
     message.sender_id = g.user.id
+    MessageCounter.update(message.receiver_id, unread=1, received=1)
+    MessageCounter.update(message.sender_id, sent=1)
     db.session.add(message)
     db.session.commit()
+    invalidate('inbox:%d' % message.receiver_id,
+               'outbox:%d' % message.sender_id)
+    publish([message.receiver_id], 'new_message', id=message.id,
+            title=message.title, sender_id=message.sender_id,
+            url=message.get_url())
     return {}, 201, {'Location': message.get_url()}
 
 
@@ -84,6 +130,11 @@ def delete_message(id):
     message = Message.query.get_or_404(id)
     if not message.is_mine():
         abort(403)
+    tags = ('inbox:%d' % message.receiver_id, 'outbox:%d' % message.sender_id)
+    MessageCounter.update(message.receiver_id, received=-1,
+                          unread=0 if message.read else -1)
+    MessageCounter.update(message.sender_id, sent=-1)
     db.session.delete(message)
     db.session.commit()
+    invalidate(*tags)
     return {}
@@ -0,0 +1,39 @@
+from flask import Response, current_app, g, request
+from . import api
+from .. import db
+from ..auth import auth_token
+
+
+@api.route('/stream', methods=['GET'])
+@auth_token.login_required
+def stream():
+    """Stream the events of the authenticated user as server-sent events,
+    with a comment line every ``EVENT_STREAM_HEARTBEAT`` seconds to keep
+    idle connections open. Clients that reconnect with a ``Last-Event-ID``
+    header first get the events they missed, when the broker keeps them."""
+    events = current_app.extensions['events']
+    heartbeat = current_app.config.get('EVENT_STREAM_HEARTBEAT', 15)
+    try:
+        after = int(request.headers.get('Last-Event-ID'))
+    except (TypeError, ValueError):
+        after = None
+    subscription = events.subscribe(g.user.id, after)
+
+    # do not hold a database connection for the lifetime of the stream
+    db.session.close()
+
+    def generate():
+        try:
+            yield ': connected\n\n'
+            while True:
+                event = subscription.get(timeout=heartbeat)
+                if event is None:
+                    yield ': heartbeat\n\n'
+                else:
+                    yield events.format(event)
+        finally:
+            subscription.close()
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
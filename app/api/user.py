@@ -1,34 +1,37 @@
-from flask import request, g, jsonify
+from flask import request, g
+from ..encoding import jsonify
 from . import api
-from .. import db, create_app
-from ..models import User, Role
-from ..decorators import json, paginate
+from .. import db, image_store, search_index
+from ..models import User, registry, load_users
+from ..decorators import json, paginate, cached, versioned_etag, read_only
+from ..cache import invalidate
 from ..auth import auth_token
+from ..exceptions import ValidationError
 from ..utils import allowed_file
-from datetime import datetime
-from werkzeug.utils import secure_filename
-import os
 from flask import url_for, current_app
 
 @api.route('/lawyers', methods=['GET'])
+@read_only
 @json
-@paginate('lawyers')
+@paginate('lawyers', keyset=(User.member_since, User.id))
 @auth_token.login_required
 def get_lawyers():
-    role = Role.query.filter_by(name='Lawyer').first()
-    return User.query.filter_by(role=role)
+    return User.query.filter_by(role_id=registry.get_id('Lawyer'))
 
 @api.route('/users', methods=['GET'])
+@read_only
 @json
-@paginate('users')
+@paginate('users', keyset=(User.member_since, User.id))
 @auth_token.login_required
 def get_users():
-    role = Role.query.filter_by(name='User').first()
-    return User.query.filter_by(role=role)
+    return User.query.filter_by(role_id=registry.get_id('User'))
 
 @api.route('/user/<int:id>', methods=['GET'])
-@json
 @auth_token.login_required
+@read_only
+@cached('user:{id}')
+@versioned_etag(User.get_version)
+@json
 def get_user(id):
     return User.query.get_or_404(id)
 
@@ -42,9 +45,8 @@ def profile():
 @json
 def new_user():
     user = User()
-    role = Role.query.filter_by(name='User').first()
     user.import_data(request.json)
-    user.role = role
+    user.role_id = registry.get_id('User')
     db.session.add(user)
     db.session.commit()
     return {'token': user.generate_auth_token(), 'user': user.export_data()}
@@ -53,7 +55,10 @@ def new_user():
 @json
 def login():
     user = User.query.filter_by(email=request.json.get('email')).first()
-    if user is not None and user.verify_password(request.json.get('password')):
+    password = request.json.get('password')
+    if user is not None and user.verify_password(password):
+        if user.upgrade_password(password):
+            db.session.commit()
         return {'token': user.generate_auth_token(), 'user': user.export_data(), 'failed':False}
     return {'failed': True}
 
@@ -61,9 +66,8 @@ def login():
 @json
 def new_lawyer():
     user = User()
-    role = Role.query.filter_by(name='Lawyer').first()
     user.import_data(request.json)
-    user.role = role
+    user.role_id = registry.get_id('Lawyer')
     db.session.add(user)
     db.session.commit()
     return {'token': user.generate_auth_token(), 'user': user.export_data()}
@@ -73,15 +77,13 @@ def new_lawyer():
 @json
 @auth_token.login_required
 def upload_user_photo():
-    app = create_app('production')
     user = g.user
     image = request.files['image']
     if image and allowed_file(image.filename):
-        imagename = "{:%I%M%S%f%d%m%Y}".format(datetime.now()) + secure_filename(image.filename)
-        image.save(os.path.join(app.config['USER_UPLOAD_FOLDER'], imagename))
-        user.image = imagename
+        user.image = image_store.save(image, current_app.config['USER_UPLOAD_FOLDER'])
     db.session.add(user)
     db.session.commit()
+    invalidate('users', 'user:%d' % user.id)
     return {'token': user.generate_auth_token(), 'user': user.export_data()}
 
 @api.route('/edit-user/<int:id>', methods=['POST'])
@@ -92,19 +94,29 @@ def edit_user(id):
     user.import_data(request.json)
     db.session.add(user)
     db.session.commit()
+    invalidate('users', 'user:%d' % id)
     return {'token': user.generate_auth_token(), 'user': user.export_data()}
 
 
 @api.route('/search', methods=['POST'])
 @auth_token.login_required
+@read_only
 def search():
-    query = request.json.get('query')
-    users =  User.query.whoosh_search(query).all()
-    role = Role.query.filter_by(name='Lawyer').first()
-    lawyers = []
-    for user in users:
-        if user.role != role:
-            continue
-        lawyers.append(user.export_data())
-    return jsonify({'result': lawyers})
+    data = request.json or {}
+    query = data.get('query') or ''
+    if not isinstance(query, str):
+        raise ValidationError('Invalid query')
+    try:
+        page = max(int(data.get('page', 1)), 1)
+        per_page = min(max(int(data.get('per_page', 25)), 1), 25)
+    except (TypeError, ValueError):
+        raise ValidationError('Invalid page or per_page')
+    ids, total = search_index.search(
+        User, query, filters={'role_id': registry.get_id('Lawyer')},
+        page=page, per_page=per_page)
+    users = load_users(ids)
+    lawyers = [users[id].export_data() for id in ids if id in users]
+    return jsonify({'result': lawyers, 'total': total, 'page': page,
+                    'per_page': per_page,
+                    'pages': (total + per_page - 1) // per_page})
     
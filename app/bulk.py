@@ -0,0 +1,150 @@
+import csv
+import io
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from . import db, hasher, search_index
+from .exceptions import ValidationError
+from .models import Comment, Feed, Message, User, registry
+
+IMPORTABLE = dict((model.__tablename__, model)
+                  for model in (User, Feed, Comment, Message))
+
+
+def read_rows(path, format=None):
+    """Stream the rows of an NDJSON or CSV file as dictionaries. The format
+    is guessed from the file extension when not given."""
+    if format is None:
+        format = 'csv' if path.endswith('.csv') else 'ndjson'
+    with io.open(path, encoding='utf-8', newline='') as f:
+        if format == 'csv':
+            for row in csv.DictReader(f):
+                yield row
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def coerce(column, value):
+    """Convert a value read from a file to the type of its column. CSV
+    files only hold strings, and so do JSON files for dates."""
+    if value == '' or value is None:
+        return None
+    if not isinstance(value, str):
+        return value
+    if isinstance(column.type, db.DateTime):
+        return datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+    if isinstance(column.type, db.Boolean):
+        return value.lower() in ('1', 'true', 'yes')
+    if isinstance(column.type, db.Integer):
+        return int(value)
+    return value
+
+
+def batched(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class BulkImporter(object):
+    """Loads rows into a table without going through the ORM.
+
+    Rows are inserted with one Core ``executemany`` per batch and one
+    commit per batch. Plain text ``password`` values are hashed on a pool
+    of ``procs`` processes, and a ``role`` name can be given instead of a
+    ``role_id``. Ids are assigned here when the rows have none, so that
+    the search index entries of each batch are written in the same pass.
+    The set of columns is taken from the first row, missing values in the
+    other rows are stored as NULL.
+
+    On Postgres the id sequence of the table is moved past the imported
+    ids afterwards, so that rows inserted later through the ORM do not
+    collide with them.
+
+    Counters are not maintained, ``manage.py rebuild_counters`` has to be
+    run after importing comments or messages."""
+    def __init__(self, model, batch_size=1000, procs=None):
+        self.model = model
+        self.table = model.__table__
+        self.batch_size = batch_size
+        self.procs = procs or os.cpu_count() or 1
+        self.searchable = hasattr(model, '__searchable__')
+        self.next_id = (db.session.query(db.func.max(model.id)).scalar()
+                        or 0) + 1
+        self.columns = None
+
+    def prepare(self, rows, pool):
+        if self.columns is None:
+            names = set(rows[0])
+            if 'password' in names:
+                names.add('password_hash')
+            if 'role' in names:
+                names.add('role_id')
+            if self.model is User:
+                names.add('role_id')
+            names.add('id')
+            self.columns = [column for column in self.table.columns
+                            if column.name in names]
+        plain = [row.get('password') for row in rows]
+        if any(password is not None for password in plain):
+            hashes = pool.map(hasher.hash_function,
+                              [password or '' for password in plain],
+                              chunksize=max(1, len(rows) // (self.procs * 4)))
+        else:
+            hashes = [None] * len(rows)
+        default_role = registry.default()
+        values = []
+        for row, password, hash in zip(rows, plain, hashes):
+            if password is not None:
+                row['password_hash'] = hash
+            if row.get('role') is not None:
+                row['role_id'] = registry.get_id(row['role'])
+                if row['role_id'] is None:
+                    raise ValidationError('Invalid role: ' + row['role'])
+            if self.model is User and row.get('role_id') in (None, '') and \
+                    default_role is not None:
+                row['role_id'] = default_role.id
+            if row.get('id') in (None, ''):
+                row['id'] = self.next_id
+            value = dict((column.name, coerce(column, row.get(column.name)))
+                         for column in self.columns)
+            self.next_id = max(self.next_id, value['id'] + 1)
+            values.append(value)
+        return values
+
+    def run(self, rows):
+        """Import the rows and return how many were imported."""
+        count = 0
+        try:
+            with ProcessPoolExecutor(self.procs) as pool:
+                for batch in batched(rows, self.batch_size):
+                    values = self.prepare(batch, pool)
+                    db.session.execute(self.table.insert(), values)
+                    db.session.commit()
+                    if self.searchable:
+                        search_index.index_rows(self.model, values)
+                    count += len(values)
+        finally:
+            if count:
+                self.reset_sequence()
+        return count
+
+    def reset_sequence(self):
+        """Move the id sequence of the table past the largest id, on the
+        databases that have one."""
+        if db.session.get_bind(self.model.__mapper__).dialect.name != \
+                'postgresql':
+            return
+        db.session.execute(
+            db.text('SELECT setval(pg_get_serial_sequence(:table, :column), '
+                    '(SELECT max(id) FROM "%s"))' % self.table.name),
+            {'table': self.table.name, 'column': 'id'})
+        db.session.commit()
@@ -0,0 +1,184 @@
+import pickle
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from flask import current_app
+
+
+class TTLCache(object):
+    """A thread safe, bounded mapping with least recently used eviction
+    and a time to live on every entry. Instances are per process, so
+    anything stored here can be up to ``ttl`` seconds stale with respect
+    to writes made by other processes."""
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteCache(object):
+    """A mapping with a time to live on every entry, shared by all the
+    processes that open the same SQLite database file. Values are pickled,
+    and expired entries are purged every ``cleanup`` writes."""
+    def __init__(self, path, ttl=300, cleanup=1000):
+        self.path = path
+        self.ttl = ttl
+        self.cleanup = cleanup
+        self._writes = 0
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache '
+                         '(key TEXT PRIMARY KEY, expires REAL, value BLOB) '
+                         'WITHOUT ROWID')
+            self._local.connection = conn
+        return conn
+
+    def get(self, key, default=None):
+        row = self.connection.execute(
+            'SELECT expires, value FROM cache WHERE key = ?',
+            (key,)).fetchone()
+        if row is None or row[0] < time.time():
+            return default
+        return pickle.loads(row[1])
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        now = time.time()
+        conn = self.connection
+        conn.execute('INSERT OR REPLACE INTO cache (key, expires, value) '
+                     'VALUES (?, ?, ?)',
+                     (key, now + ttl, pickle.dumps(value, protocol=-1)))
+        self._writes += 1
+        if self._writes >= self.cleanup:
+            self._writes = 0
+            conn.execute('DELETE FROM cache WHERE expires < ?', (now,))
+
+    def delete(self, key):
+        self.connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def clear(self):
+        self.connection.execute('DELETE FROM cache')
+
+
+def get_backend(app, name, path, ttl):
+    """Return the cache backend named by a configuration value:
+    ``'memory'`` for a ``TTLCache`` of the current process, ``'sqlite'``
+    for a ``SQLiteCache`` at ``path`` shared by all the workers of a host,
+    or a callable that takes the application and returns a backend."""
+    if callable(name):
+        return name(app)
+    if name == 'memory':
+        return TTLCache(maxsize=app.config.get('RESPONSE_CACHE_SIZE', 1024),
+                        ttl=ttl)
+    if name == 'sqlite':
+        return SQLiteCache(path, ttl=ttl)
+    raise ValueError('Unknown cache backend: ' + name)
+
+
+class ResponseCache(object):
+    """Server side cache of rendered responses.
+
+    Entries are stored in a pluggable backend, which is any object with
+    ``get(key)``, ``set(key, value, ttl)`` and ``delete(key)`` methods,
+    selected with ``RESPONSE_CACHE_BACKEND`` as described in
+    ``get_backend``. The default is an in-process ``TTLCache``.
+
+    Invalidation works through tags. Each tag has a version token, and
+    every cache key includes the versions of its tags, so invalidating a
+    tag just replaces its version and all the entries that carry it become
+    unreachable. The versions are kept in the backend named by
+    ``RESPONSE_CACHE_TAG_BACKEND``, the response backend by default. With
+    several workers it has to be shared, for example ``'sqlite'`` at
+    ``RESPONSE_CACHE_TAG_PATH``, or an invalidation only reaches the
+    worker that made it, while the rendered responses can stay in the
+    memory of each worker."""
+    def __init__(self, app=None):
+        self.backend = None
+        self.tags = None
+        self.ttl = 60
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get('RESPONSE_CACHE_TTL', 60)
+        self.backend = get_backend(
+            app, app.config.get('RESPONSE_CACHE_BACKEND') or 'memory',
+            app.config.get('RESPONSE_CACHE_PATH'), self.ttl)
+        tags = app.config.get('RESPONSE_CACHE_TAG_BACKEND')
+        self.tags = self.backend if tags is None else get_backend(
+            app, tags, app.config.get('RESPONSE_CACHE_TAG_PATH'),
+            self.ttl * 10)
+        app.extensions['response_cache'] = self
+
+    def _tag_version(self, tag):
+        key = 'tag:' + tag
+        version = self.tags.get(key)
+        if version is None:
+            version = uuid.uuid4().hex
+            self.tags.set(key, version, self.ttl * 10)
+        return version
+
+    def make_key(self, key, tags):
+        versions = [self._tag_version(tag) for tag in tags]
+        return 'response:' + repr((key, versions))
+
+    def get(self, key, tags):
+        return self.backend.get(self.make_key(key, tags))
+
+    def set(self, key, tags, value):
+        self.backend.set(self.make_key(key, tags), value, self.ttl)
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            self.tags.set('tag:' + tag, uuid.uuid4().hex, self.ttl * 10)
+
+
+def invalidate(*tags):
+    """Invalidate the cached responses that carry any of the given tags."""
+    cache = current_app.extensions.get('response_cache')
+    if cache is not None:
+        cache.invalidate(*tags)
@@ -0,0 +1,165 @@
+import itertools
+import time
+from flask import g, has_request_context
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import event, orm
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+from .cache import TTLCache
+from .ratelimit import get_store
+
+
+class ReplicaSet(object):
+    """The read replicas of an application and their state.
+
+    Replicas are handed out round-robin, skipping the ones that failed
+    during the last ``retry`` seconds. Users that have just written to the
+    primary are pinned to it for ``window`` seconds, so that they read
+    their own writes even when the replicas lag behind. Pins are kept as
+    expiry times in ``store``, one of the rate limit stores, which has to
+    be shared by all the workers for the pins to follow users between
+    them."""
+    def __init__(self, keys, store, window=5, retry=30):
+        self.keys = keys
+        self.store = store
+        self.window = window
+        self._cycle = itertools.cycle(keys)
+        self._down = TTLCache(ttl=retry)
+        self._engines = {}
+
+    def choose(self):
+        for i in range(len(self.keys)):
+            key = next(self._cycle)
+            if self._down.get(key) is None:
+                return key
+        return None
+
+    def engine(self, app, key):
+        engine = app.extensions['sqlalchemy'].db.get_engine(app, bind=key)
+        if engine not in self._engines:
+            self._engines[engine] = key
+            event.listen(engine, 'handle_error', self.on_error)
+        return engine
+
+    def mark_down(self, key):
+        self._down.set(key, True)
+
+    def on_error(self, context):
+        if context.is_disconnect or \
+                isinstance(context.sqlalchemy_exception, OperationalError):
+            self.mark_down(self._engines[context.engine])
+
+    def pin(self, user_id):
+        expires = time.time() + self.window
+        self.store.update('primary:%d' % user_id,
+                          lambda old: (max(old or 0, expires), None))
+
+    def is_pinned(self, user_id):
+        expires = self.store.get('primary:%d' % user_id)
+        return expires is not None and expires > time.time()
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends the reads of read only routes to a replica.
+
+    Reads go to a replica when the route is marked with ``@read_only``, the
+    user is authenticated, so that authentication itself always reads from
+    the primary, and the user is not pinned to the primary after a write.
+    The replica is chosen and connected to once per request, and a replica
+    that cannot be reached is marked down and replaced by the primary.
+    Writes always go to the primary and pin the user to it."""
+    def get_bind(self, mapper=None, clause=None):
+        replicas = self.app.extensions.get('db_replicas')
+        if replicas is None or not has_request_context() or \
+                (mapper is not None and
+                 mapper.persist_selectable.info.get('bind_key')):
+            return super(RoutingSession, self).get_bind(mapper, clause)
+        user = g.get('user')
+        if self._flushing or isinstance(clause, UpdateBase):
+            g.read_only = False
+            if user is not None and not g.get('pinned'):
+                replicas.pin(user.id)
+                g.pinned = True
+        elif g.get('read_only') and user is not None:
+            if 'replica' not in g:
+                g.replica = None if replicas.is_pinned(user.id) \
+                    else replicas.choose()
+                if g.replica is not None:
+                    engine = replicas.engine(self.app, g.replica)
+                    try:
+                        # the session keeps the connection for the request
+                        self.connection(bind=engine)
+                    except OperationalError:
+                        replicas.mark_down(g.replica)
+                        g.replica = None
+            if g.replica is not None:
+                return replicas.engine(self.app, g.replica)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class Database(SQLAlchemy):
+    """Flask-SQLAlchemy with the engine tuned from the configuration.
+
+    Pool settings (``pool_size``, ``max_overflow``, ``pool_pre_ping``,
+    ``pool_recycle``) go in ``SQLALCHEMY_ENGINE_OPTIONS`` and apply to
+    Postgres and SQLite alike. Flask-SQLAlchemy opens a new connection for
+    every checkout on an SQLite file unless a ``pool_size`` is set, in
+    which case connections are pooled and shared between threads. Every new
+    SQLite connection runs the ``SQLITE_PRAGMAS``, for example WAL mode so
+    that readers do not block the writer, and a busy timeout so that
+    concurrent writers wait for the lock instead of failing with "database
+    is locked".
+
+    ``SQLALCHEMY_REPLICAS`` is an optional list of read replica URLs, see
+    ``RoutingSession``. They are added to the binds as ``replica0``,
+    ``replica1``... with no tables of their own, so ``create_all`` leaves
+    them alone. ``SQLALCHEMY_REPLICA_WINDOW`` is the number of seconds a
+    user reads from the primary after writing, 5 by default, and
+    ``SQLALCHEMY_REPLICA_PIN_STORE`` and ``SQLALCHEMY_REPLICA_PIN_STORE_PATH``
+    select where that is remembered, like the rate limit store settings.
+    The default ``'memory'`` store only works with a single worker."""
+    def init_app(self, app):
+        replicas = app.config.get('SQLALCHEMY_REPLICAS') or []
+        if replicas:
+            binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+            keys = []
+            for i, uri in enumerate(replicas):
+                keys.append('replica%d' % i)
+                binds[keys[-1]] = uri
+            app.config['SQLALCHEMY_BINDS'] = binds
+        super(Database, self).init_app(app)
+        if replicas:
+            app.extensions['db_replicas'] = ReplicaSet(
+                keys, get_store(app, 'SQLALCHEMY_REPLICA_PIN'),
+                window=app.config.get('SQLALCHEMY_REPLICA_WINDOW', 5))
+            app.before_request(self.reset_routing)
+
+    @staticmethod
+    def reset_routing():
+        # requests can share an application context, and with it g
+        for name in ('read_only', 'replica', 'pinned'):
+            g.pop(name, None)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super(Database, self).apply_driver_hacks(app, sa_url, options)
+        if sa_url.drivername == 'sqlite' and \
+                sa_url.database not in (None, '', ':memory:') and \
+                app.config['SQLALCHEMY_ENGINE_OPTIONS'].get('pool_size'):
+            options['poolclass'] = QueuePool
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super(Database, self).create_engine(sa_url, engine_opts)
+        pragmas = self.get_app().config.get('SQLITE_PRAGMAS')
+        if engine.dialect.name == 'sqlite' and pragmas:
+            @event.listens_for(engine, 'connect')
+            def set_pragmas(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                for name, value in pragmas.items():
+                    cursor.execute('PRAGMA %s = %s' % (name, value))
+                cursor.close()
+        return engine
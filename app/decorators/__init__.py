@@ -1,3 +1,4 @@
 from .json import json
 from .paginate import paginate
-from .caching import cache_control, no_cache, etag
\ No newline at end of file
+from .caching import cache_control, no_cache, etag, versioned_etag, cached
+from .routing import read_only
@@ -1,6 +1,6 @@
 import functools
 import hashlib
-from flask import request, make_response, jsonify
+from flask import request, make_response, jsonify, current_app, g
 
 
 def cache_control(*directives):
@@ -27,6 +27,61 @@ def no_cache(f):
     return cache_control('private', 'no-cache', 'no-store', 'max-age=0')(f)
 
 
+def cached(*tags):
+    """Serve the decorated GET route from the server side response cache.
+
+    The cache key is built from the endpoint, the view arguments, the query
+    string and the authenticated user. The tags are formatted with the view
+    arguments and a ``user`` argument, for example ``'feed:{id}'``, and are
+    used by the routes that modify data to invalidate the cached responses
+    that depend on it. Authentication must happen before this decorator
+    runs, so that cached responses are never returned to anonymous
+    clients.
+
+    The headers of the response are stored with it, so when this decorator
+    wraps ``@versioned_etag`` the etag is cached next to the body, under the
+    same tags, and conditional requests that hit the cache are answered
+    without running the version query."""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            cache = current_app.extensions.get('response_cache')
+            if cache is None or request.method not in ['GET', 'HEAD']:
+                return f(*args, **kwargs)
+
+            # build the key and the tags of this request
+            user = getattr(g, 'user', None)
+            user_id = user.id if user is not None else None
+            names = [tag.format(user=user_id, **kwargs) for tag in tags]
+            key = (request.host, request.endpoint, sorted(kwargs.items()),
+                   sorted(request.args.items(multi=True)), user_id)
+
+            # on a hit, rebuild the response without invoking the view
+            hit = cache.get(key, names)
+            if hit is not None:
+                data, status, headers = hit
+                etag = dict(headers).get('ETag')
+                if etag is not None:
+                    rv = check_preconditions(etag)
+                    if rv is not None:
+                        return rv
+                rv = current_app.response_class(data, status=status,
+                                                headers=headers)
+                rv.headers['X-Cache'] = 'HIT'
+                return rv
+
+            # on a miss, invoke the wrapped function and store successful
+            # responses
+            rv = make_response(f(*args, **kwargs))
+            if rv.status_code == 200:
+                cache.set(key, names, (rv.get_data(), rv.status_code,
+                                       list(rv.headers)))
+            rv.headers['X-Cache'] = 'MISS'
+            return rv
+        return wrapped
+    return decorator
+
+
 def etag(f):
     """Add entity tag (etag) handling to the decorated route."""
     @functools.wraps(f)
@@ -52,27 +107,79 @@ def etag(f):
         rv.headers['ETag'] = etag
 
         # handle If-Match and If-None-Match request headers if present
-        if_match = request.headers.get('If-Match')
-        if_none_match = request.headers.get('If-None-Match')
-        if if_match:
-            # only return the response if the etag for this request matches
-            # any of the etags given in the If-Match header. If there is no
-            # match, then return a 412 Precondition Failed status code
-            etag_list = [tag.strip() for tag in if_match.split(',')]
-            if etag not in etag_list and '*' not in etag_list:
-                response = jsonify({'status': 412, 'error': 'precondition failed',
-                                    'message': 'precondition failed'})
-                response.status_code = 412
-                return response
-        elif if_none_match:
-            # only return the response if the etag for this request does not
-            # match any of the etags given in the If-None-Match header. If
-            # one matches, then return a 304 Not Modified status code
-            etag_list = [tag.strip() for tag in if_none_match.split(',')]
-            if etag in etag_list or '*' in etag_list:
-                response = jsonify({'status': 304, 'error': 'not modified',
-                                    'message': 'resource not modified'})
-                response.status_code = 304
-                return response
-        return rv
-    return wrapped
\ No newline at end of file
+        return check_preconditions(etag) or rv
+    return wrapped
+
+
+def versioned_etag(version):
+    """Add entity tag (etag) handling to the decorated route, using a cheap
+    version of the resource instead of a hash of the rendered response.
+
+    ``version`` is called with the view arguments before the view runs, and
+    must return a value that changes whenever the response would, such as
+    the ``updated_at`` column of a row or the high-water mark of a
+    collection. If it returns None the request is handled without an etag.
+    The version only covers the data, so the etag also includes the URL,
+    query string included, and the authenticated user, and different pages
+    of a collection never share an etag. Conditional requests that match
+    are answered without invoking the view.
+
+    Place ``@cached`` above this decorator, so that cache hits are served
+    with their stored etag instead of running the version query."""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            assert request.method in ['GET', 'HEAD'],\
+                '@versioned_etag is only supported on GET and HEAD requests'
+
+            # compute the etag for this request from the resource version
+            v = version(*args, **kwargs)
+            if v is None:
+                return f(*args, **kwargs)
+            user = getattr(g, 'user', None)
+            v = (request.path, sorted(request.args.items(multi=True)),
+                 user.id if user is not None else None, v)
+            etag = '"' + hashlib.md5(repr(v).encode('utf-8')).hexdigest() + '"'
+
+            # handle If-Match and If-None-Match request headers if present
+            rv = check_preconditions(etag)
+            if rv is not None:
+                return rv
+
+            # invoke the wrapped function and tag the response. The version
+            # was taken before the view ran, so the response can only be
+            # newer than its etag, never older
+            rv = make_response(f(*args, **kwargs))
+            if rv.status_code == 200:
+                rv.headers['ETag'] = etag
+            return rv
+        return wrapped
+    return decorator
+
+
+def check_preconditions(etag):
+    """Return the response to a conditional request for a resource with the
+    given etag, or None if the request should be handled normally."""
+    if_match = request.headers.get('If-Match')
+    if_none_match = request.headers.get('If-None-Match')
+    if if_match:
+        # only return the response if the etag for this request matches
+        # any of the etags given in the If-Match header. If there is no
+        # match, then return a 412 Precondition Failed status code
+        etag_list = [tag.strip() for tag in if_match.split(',')]
+        if etag not in etag_list and '*' not in etag_list:
+            response = jsonify({'status': 412, 'error': 'precondition failed',
+                                'message': 'precondition failed'})
+            response.status_code = 412
+            return response
+    elif if_none_match:
+        # only return the response if the etag for this request does not
+        # match any of the etags given in the If-None-Match header. If
+        # one matches, then return a 304 Not Modified status code
+        etag_list = [tag.strip() for tag in if_none_match.split(',')]
+        if etag in etag_list or '*' in etag_list:
+            response = jsonify({'status': 304, 'error': 'not modified',
+                                'message': 'resource not modified'})
+            response.status_code = 304
+            return response
+    return None
\ No newline at end of file
@@ -1,5 +1,5 @@
 import functools
-from flask import jsonify
+from ..encoding import jsonify
 
 
 def json(f):
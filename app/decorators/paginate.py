@@ -1,13 +1,80 @@
 import functools
-from flask import url_for, request
+from datetime import datetime
+from dateutil import parser as datetime_parser
+from flask import url_for, request, current_app
+from itsdangerous import URLSafeSerializer, BadSignature
+from sqlalchemy import and_, or_
+from ..exceptions import ValidationError
 
 
-def paginate(collection, max_per_page=25):
+def export_collection(items):
+    """Export a list of models to dictionaries. Models that define an
+    ``export_collection`` static method get to export the whole list in
+    bulk, which lets them batch the queries they need."""
+    if items and hasattr(items[0], 'export_collection'):
+        return items[0].export_collection(items)
+    return [item.export_data() for item in items]
+
+
+def _cursor_serializer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'],
+                             salt='paginate-cursor')
+
+
+def encode_cursor(item, keyset):
+    """Build an opaque cursor that points just past the given item."""
+    values = []
+    for column in keyset:
+        value = getattr(item, column.key)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        values.append(value)
+    return _cursor_serializer().dumps(values)
+
+
+def decode_cursor(cursor, keyset):
+    """Return the key values stored in a cursor made by encode_cursor."""
+    try:
+        values = _cursor_serializer().loads(cursor)
+    except BadSignature:
+        raise ValidationError('Invalid cursor: ' + cursor)
+    if not isinstance(values, list) or len(values) != len(keyset):
+        raise ValidationError('Invalid cursor: ' + cursor)
+    for i, column in enumerate(keyset):
+        if values[i] is not None and \
+                column.type.python_type is datetime:
+            values[i] = datetime_parser.parse(values[i])
+    return values
+
+
+def keyset_filter(keyset, values):
+    """Return a condition that selects the rows that come after the given
+    key values when the query is sorted by the keyset in descending
+    order. This is the expanded form of ``(a, b) < (x, y)``, which not all
+    databases support."""
+    clauses = []
+    for i, column in enumerate(keyset):
+        equal = [keyset[j] == values[j] for j in range(i)]
+        clauses.append(and_(*(equal + [column < values[i]])))
+    return or_(*clauses)
+
+
+def paginate(collection, max_per_page=25, keyset=None,
+             keyset_default=False):
     """Generate a paginated response for a resource collection.
 
     Routes that use this decorator must return a SQLAlchemy query as a
     response.
 
+    When a ``keyset`` tuple of columns is given, for example
+    ``(Feed.timestamp, Feed.id)``, clients can opt in to cursor pagination
+    by sending a ``cursor`` argument in the query string (empty for the
+    first page). The collection is then returned newest first and each
+    page is fetched with an indexed range scan, without a total count or
+    an offset, so deep pages cost the same as the first one. With
+    ``keyset_default=True`` this is also what clients get when they send
+    neither a cursor nor a page number.
+
     The output of this decorator is a Python dictionary with the paginated
     results. The application must ensure that this result is converted to a
     response object, either by chaining another decorator or by using a
@@ -20,12 +87,17 @@ def paginate(collection, max_per_page=25):
 
             # obtain pagination arguments from the URL's query string
             page = request.args.get('page', 1, type=int)
-            per_page = min(request.args.get('per_page', max_per_page,
-                                            type=int), max_per_page)
+            per_page = min(max(request.args.get('per_page', max_per_page,
+                                                type=int), 1), max_per_page)
             expanded = None
             if request.args.get('expanded', 0, type=int) != 0:
                 expanded = 1
 
+            if keyset is not None and ('cursor' in request.args or
+                                       keyset_default and
+                                       'page' not in request.args):
+                return paginate_keyset(query, per_page, expanded, kwargs)
+
             # run the query with Flask-SQLAlchemy's pagination
             p = query.paginate(page, per_page)
 
@@ -55,12 +127,43 @@ def paginate(collection, max_per_page=25):
 
             # generate the paginated collection as a dictionary
             if expanded:
-                results = [item.export_data() for item in p.items]
+                results = export_collection(p.items)
             else:
-                results = [item.export_data() for item in p.items]
+                results = export_collection(p.items)
                 # results = [item.get_url() for item in p.items]
 
             # return a dictionary as a response
             return {collection: results, 'pages': pages}
+
+        def paginate_keyset(query, per_page, expanded, kwargs):
+            # sort by the keyset and resume after the cursor, if any
+            query = query.order_by(None).order_by(
+                *[column.desc() for column in keyset])
+            cursor = request.args.get('cursor')
+            if cursor:
+                query = query.filter(
+                    keyset_filter(keyset, decode_cursor(cursor, keyset)))
+
+            # fetch one extra row to find out if there is a next page
+            items = query.limit(per_page + 1).all()
+            has_next = len(items) > per_page
+            items = items[:per_page]
+
+            # build the pagination metadata to include in the response
+            pages = {'per_page': per_page, 'next_cursor': None,
+                     'next_url': None}
+            if has_next:
+                pages['next_cursor'] = encode_cursor(items[-1], keyset)
+                pages['next_url'] = url_for(request.endpoint,
+                                            cursor=pages['next_cursor'],
+                                            per_page=per_page,
+                                            expanded=expanded,
+                                            _external=True, **kwargs)
+            pages['first_url'] = url_for(request.endpoint, cursor='',
+                                         per_page=per_page, expanded=expanded,
+                                         _external=True, **kwargs)
+
+            # return a dictionary as a response
+            return {collection: export_collection(items), 'pages': pages}
         return wrapped
     return decorator
@@ -0,0 +1,13 @@
+import functools
+from flask import g
+
+
+def read_only(f):
+    """Mark a route as read only, so that its queries can be sent to a
+    read replica of the database. The route must not write to the
+    database, not even through the helpers it calls."""
+    @functools.wraps(f)
+    def wrapped(*args, **kwargs):
+        g.read_only = True
+        return f(*args, **kwargs)
+    return wrapped
@@ -0,0 +1,123 @@
+import json as stdlib_json
+import uuid
+from datetime import date, datetime
+from flask import current_app, jsonify as flask_jsonify
+from .serializers import http_date
+
+
+def default(o):
+    """Encode the types Flask's JSON encoder knows about and JSON does
+    not. The serializers hand over dates already formatted, so this is
+    only called for the dictionaries built by hand in the routes."""
+    if isinstance(o, datetime):
+        return http_date(o)
+    if isinstance(o, date):
+        return http_date(datetime(o.year, o.month, o.day))
+    if isinstance(o, uuid.UUID):
+        return str(o)
+    if hasattr(o, '__html__'):
+        return str(o.__html__())
+    raise TypeError('Object of type %s is not JSON serializable' %
+                    type(o).__name__)
+
+
+def orjson_encoder(app):
+    import orjson
+    option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+    if app.config.get('JSON_SORT_KEYS', True):
+        option |= orjson.OPT_SORT_KEYS
+
+    def dumps(obj):
+        return orjson.dumps(obj, default=default, option=option)
+    return dumps
+
+
+def ujson_encoder(app):
+    import ujson
+    sort_keys = app.config.get('JSON_SORT_KEYS', True)
+    ensure_ascii = app.config.get('JSON_AS_ASCII', True)
+
+    def dumps(obj):
+        return ujson.dumps(obj, default=default, sort_keys=sort_keys,
+                           ensure_ascii=ensure_ascii,
+                           escape_forward_slashes=False)
+    return dumps
+
+
+def stdlib_encoder(app):
+    encoder = stdlib_json.JSONEncoder(
+        separators=(',', ':'), default=default,
+        sort_keys=app.config.get('JSON_SORT_KEYS', True),
+        ensure_ascii=app.config.get('JSON_AS_ASCII', True))
+    return encoder.encode
+
+
+ENCODERS = {
+    'orjson': orjson_encoder,
+    'ujson': ujson_encoder,
+    'stdlib': stdlib_encoder,
+}
+
+
+def get_encoder(app):
+    name = app.config.get('JSON_ENCODER', 'auto')
+    if callable(name):
+        return getattr(name, '__name__', 'custom'), name(app)
+    if name == 'auto':
+        for name in ('orjson', 'ujson'):
+            try:
+                return name, ENCODERS[name](app)
+            except ImportError:
+                pass
+        name = 'stdlib'
+    if name not in ENCODERS:
+        raise ValueError('Unknown JSON encoder: ' + name)
+    return name, ENCODERS[name](app)
+
+
+class Encoder(object):
+    """Encodes the JSON responses of the API.
+
+    ``JSON_ENCODER`` selects the library: ``'orjson'`` or ``'ujson'``,
+    which are written in C, ``'stdlib'`` for the standard library's
+    ``json`` module, or ``'auto'`` (the default) for the first of them that
+    is installed. It can also be a callable that takes the application and
+    returns a function that encodes an object to ``str`` or ``bytes``.
+    ``JSON_SORT_KEYS`` is honored, and so is ``JSON_AS_ASCII`` except by
+    orjson, which always writes UTF-8. Responses are compact, debug mode
+    included, unless ``JSONIFY_PRETTYPRINT_REGULAR`` is set, in which case
+    they are left to Flask."""
+    def __init__(self, app=None):
+        self.name = None
+        self.dumps = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.name, self.dumps = get_encoder(app)
+        app.extensions['json'] = self
+
+    def response(self, data, status=None):
+        config = current_app.config
+        if config['JSONIFY_PRETTYPRINT_REGULAR']:
+            rv = flask_jsonify(data)
+            if status is not None:
+                rv.status_code = status
+            return rv
+        body = self.dumps(data)
+        if isinstance(body, bytes):
+            body += b'\n'
+        else:
+            body += '\n'
+        return current_app.response_class(body, status=status,
+                                          mimetype=config['JSONIFY_MIMETYPE'])
+
+
+def jsonify(*args, **kwargs):
+    """Drop in replacement for Flask's ``jsonify`` that goes through the
+    application's encoder."""
+    if args and kwargs:
+        raise TypeError('jsonify() behavior undefined when passed both args '
+                        'and kwargs')
+    data = args[0] if len(args) == 1 else (args or kwargs)
+    return current_app.extensions['json'].response(data)
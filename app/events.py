@@ -0,0 +1,226 @@
+import itertools
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription(object):
+    """The events delivered to one subscriber, in a bounded queue. Events
+    are dropped when a subscriber falls ``maxsize`` events behind."""
+    def __init__(self, broker, channel, maxsize=100):
+        self.broker = broker
+        self.channel = channel
+        self.queue = queue.Queue(maxsize)
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            pass
+
+    def get(self, timeout=None):
+        """Return the next event, or None if none arrives in time."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class MemoryBroker(object):
+    """Publish/subscribe broker that delivers events to the subscribers of
+    the current process, so it only works when the application is served
+    by a single process. Events are numbered in the order they are
+    published, and ``after`` is ignored, as no events are kept."""
+    def __init__(self):
+        self._channels = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel, after=None):
+        subscription = Subscription(self, channel)
+        with self._lock:
+            self._channels.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._channels.get(subscription.channel, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._channels.pop(subscription.channel, None)
+
+    def publish(self, channel, event):
+        with self._lock:
+            if 'id' not in event:
+                event = dict(event, id=next(self._ids))
+            subscriptions = list(self._channels.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.put(event)
+
+
+class SQLiteBroker(object):
+    """Publish/subscribe broker shared by all the processes that open the
+    same SQLite database file.
+
+    Published events are appended to a table, whose row ids number them
+    the same way in every process. A thread in each process that has
+    subscribers polls the table every ``poll`` seconds and hands the new
+    events to them. Events are kept for ``retention`` seconds, so that a
+    client that reconnects with the id of the last event it got, possibly
+    to another process, receives the events it missed."""
+    def __init__(self, path, poll=0.5, retention=300):
+        self.path = path
+        self.poll = poll
+        self.retention = retention
+        self._subscribers = MemoryBroker()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._last = 0
+        self._pruned = 0
+
+    @property
+    def connection(self):
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS events '
+                         '(id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'channel TEXT NOT NULL, event TEXT NOT NULL, '
+                         'created REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_events_channel '
+                         'ON events (channel, id)')
+            self._local.connection = conn
+        return conn
+
+    def subscribe(self, channel, after=None):
+        conn = self.connection
+        with self._lock:
+            if self._thread is None:
+                # started on first use, so that each worker process gets
+                # its own, and only delivers the events published from now
+                self._last = conn.execute(
+                    'SELECT coalesce(max(id), 0) FROM events').fetchone()[0]
+                self._thread = threading.Thread(target=self.run,
+                                                name='event-broker')
+                self._thread.daemon = True
+                self._thread.start()
+            subscription = self._subscribers.subscribe(channel)
+            subscription.broker = self
+            if after is not None:
+                for id, event in conn.execute(
+                        'SELECT id, event FROM events WHERE channel = ? AND '
+                        'id > ? AND id <= ? ORDER BY id',
+                        (channel, after, self._last)):
+                    subscription.put(dict(json.loads(event), id=id))
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self._subscribers.unsubscribe(subscription)
+
+    def publish(self, channel, event):
+        self.connection.execute(
+            'INSERT INTO events (channel, event, created) VALUES (?, ?, ?)',
+            (channel, json.dumps(event), time.time()))
+
+    def dispatch(self):
+        """Deliver the events published since the last call."""
+        conn = self.connection
+        with self._lock:
+            rows = conn.execute('SELECT id, channel, event FROM events '
+                                'WHERE id > ? ORDER BY id',
+                                (self._last,)).fetchall()
+            for id, channel, event in rows:
+                self._subscribers.publish(channel,
+                                          dict(json.loads(event), id=id))
+            if rows:
+                self._last = rows[-1][0]
+        now = time.time()
+        if now - self._pruned > self.retention / 10.0:
+            conn.execute('DELETE FROM events WHERE created < ?',
+                         (now - self.retention,))
+            self._pruned = now
+
+    def run(self):
+        while True:
+            time.sleep(self.poll)
+            try:
+                self.dispatch()
+            except Exception:
+                logger.exception('Could not read the published events')
+
+
+def get_broker(app):
+    broker = app.config.get('EVENT_BROKER', 'memory')
+    if callable(broker):
+        return broker(app)
+    if broker == 'memory':
+        return MemoryBroker()
+    if broker == 'sqlite':
+        return SQLiteBroker(app.config['EVENT_BROKER_PATH'],
+                            app.config.get('EVENT_BROKER_POLL', 0.5),
+                            app.config.get('EVENT_BROKER_RETENTION', 300))
+    raise ValueError('Unknown event broker: ' + broker)
+
+
+class EventStream(object):
+    """Events pushed to users over server-sent events.
+
+    Events are published to a channel per user through the broker named
+    by ``EVENT_BROKER``: ``'memory'`` (the default) for a ``MemoryBroker``,
+    which only reaches the streams of its own process, ``'sqlite'`` for a
+    ``SQLiteBroker`` at ``EVENT_BROKER_PATH`` shared by all the workers of
+    a host, or a callable that takes the application and returns an object
+    with the same ``subscribe``, ``unsubscribe`` and ``publish`` methods.
+    Brokers number the events, and a broker shared by several processes
+    has to number them the same way in all of them, since clients resume
+    from the id of the last event they got.
+
+    Each open stream holds a connection and waits on its subscription, so
+    to hold many idle streams cheaply, serve the application with a
+    cooperative server, for example ``gunicorn -k gevent``, which turns
+    these waits into green threads."""
+    def __init__(self, app=None):
+        self.broker = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.broker = get_broker(app)
+        app.extensions['events'] = self
+
+    def subscribe(self, user_id, after=None):
+        """Subscribe to the events of a user, starting with the ones
+        published after the event numbered ``after`` that the broker still
+        has."""
+        return self.broker.subscribe('user:%d' % user_id, after)
+
+    def publish(self, user_id, name, data):
+        self.broker.publish('user:%d' % user_id,
+                            {'event': name, 'data': data})
+
+    @staticmethod
+    def format(event):
+        """Encode an event in the server-sent events format."""
+        return 'id: %d\nevent: %s\ndata: %s\n\n' % (
+            event['id'], event['event'], json.dumps(event['data']))
+
+
+def publish(user_ids, name, **data):
+    """Push an event to the streams of the given users."""
+    events = current_app.extensions.get('events')
+    if events is not None:
+        for user_id in set(user_ids):
+            events.publish(user_id, name, data)
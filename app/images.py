@@ -0,0 +1,160 @@
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from flask import url_for
+from werkzeug.utils import secure_filename
+from .exceptions import ValidationError
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+# resized variants generated for every uploaded image, as maximum
+# (width, height) boxes that preserve the aspect ratio
+VARIANTS = {
+    'thumbnail': (160, 160),
+    'medium': (640, 640),
+}
+
+
+def variant_name(imagename, variant):
+    return variant + '_' + imagename
+
+
+def is_variant(imagename):
+    return any(imagename.startswith(variant + '_') for variant in VARIANTS)
+
+
+def static_url(filename):
+    return url_for('static', filename=filename, _external=True)
+
+
+def variant_urls(folder, imagename, url=static_url):
+    """Return the URLs of the resized variants of an image. A variant file
+    exists for every stored image, starting as a link to the original, and
+    the default avatar ships with its variants, so the URLs are derived
+    from the name alone. ``url`` turns a static
+    filename into its URL."""
+    return dict((variant, url(folder + variant_name(imagename, variant)))
+                for variant in VARIANTS)
+
+
+def link(source, path):
+    """Make ``path`` a hard link to ``source``, or a copy of it on file
+    systems without hard links."""
+    try:
+        os.link(source, path)
+    except OSError:
+        shutil.copyfile(source, path)
+
+
+class ImageStore(object):
+    """Saves uploaded images and generates their resized variants.
+
+    Werkzeug spools each upload to memory or a temporary file while the
+    request is parsed. The spooled upload is then copied into the upload
+    folder in bounded chunks, and rejected once it goes over
+    ``MAX_IMAGE_SIZE`` bytes. Every variant starts as a link to the
+    original and is replaced by the resized image once it is ready.
+    Resizing happens in a pool of ``IMAGE_WORKERS`` background threads, so
+    requests never wait for images to be decoded. Without Pillow installed
+    the variants stay links to the originals."""
+    def __init__(self, app=None):
+        self.max_size = 8 * 1024 * 1024
+        self.workers = 2
+        self._executor = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_size = app.config.get('MAX_IMAGE_SIZE', self.max_size)
+        self.workers = app.config.get('IMAGE_WORKERS', self.workers)
+        app.extensions['images'] = self
+
+    @property
+    def executor(self):
+        # created on first use, so that each worker process gets its own
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.workers)
+        return self._executor
+
+    def save(self, image, folder):
+        """Save an uploaded image in the given folder, schedule the
+        generation of its variants and return its filename."""
+        imagename = "{:%I%M%S%f%d%m%Y}".format(datetime.now()) + \
+            secure_filename(image.filename)
+        path = os.path.join(folder, imagename)
+        partial = path + '.part'
+        size = 0
+        try:
+            with open(partial, 'wb') as f:
+                while True:
+                    chunk = image.stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > self.max_size:
+                        raise ValidationError('Image too large: the maximum '
+                                              'size is %d bytes' %
+                                              self.max_size)
+                    f.write(chunk)
+            os.rename(partial, path)
+        except:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        for variant in VARIANTS:
+            link(path, os.path.join(folder, variant_name(imagename, variant)))
+        if Image is not None:
+            self.executor.submit(self.make_variants, folder, imagename)
+        return imagename
+
+    def make_variants(self, folder, imagename):
+        """Generate the resized variants of an image. Runs in the worker
+        pool."""
+        try:
+            with Image.open(os.path.join(folder, imagename)) as source:
+                for variant, size in VARIANTS.items():
+                    resized = source.copy()
+                    resized.thumbnail(size)
+                    path = os.path.join(folder,
+                                        variant_name(imagename, variant))
+                    resized.save(path + '.part', format=source.format)
+                    os.replace(path + '.part', path)
+        except Exception:
+            # clients keep receiving the original image for this upload
+            logger.exception('Could not resize image %s', imagename)
+
+    def add_variants(self, folder):
+        """Create the variants of the images of a folder that have none,
+        such as the ones stored before variants existed, and return how
+        many images were resized. Runs in the calling thread."""
+        count = 0
+        for imagename in sorted(os.listdir(folder)):
+            path = os.path.join(folder, imagename)
+            if is_variant(imagename) or imagename.endswith('.part') or \
+                    not os.path.isfile(path):
+                continue
+            missing = [variant for variant in VARIANTS if not os.path.exists(
+                os.path.join(folder, variant_name(imagename, variant)))]
+            if not missing:
+                continue
+            for variant in missing:
+                link(path, os.path.join(folder,
+                                        variant_name(imagename, variant)))
+            if Image is not None:
+                self.make_variants(folder, imagename)
+            count += 1
+        return count
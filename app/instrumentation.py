@@ -0,0 +1,70 @@
+import logging
+import time
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    context._query_start = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    if not has_request_context():
+        return
+    stats = g.get('query_stats')
+    if stats is None:
+        return
+    elapsed = time.perf_counter() - context._query_start
+    stats['count'] += 1
+    stats['time'] += elapsed
+    if elapsed >= stats['threshold']:
+        logger.warning('Slow query in %s (%.1f ms): %s', request.endpoint,
+                       elapsed * 1000, statement)
+
+
+class QueryStats(object):
+    """Per request database instrumentation.
+
+    When ``DB_INSTRUMENTATION`` is enabled, the SQL statements issued while
+    handling each request are counted and timed, and the totals are
+    returned in a ``Server-Timing`` response header. Statements that take
+    longer than ``DB_SLOW_QUERY_THRESHOLD`` seconds (0.5 by default) are
+    logged along with the endpoint that issued them. Nothing is installed
+    when instrumentation is disabled, which is the default."""
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config.get('DB_INSTRUMENTATION'):
+            return
+        app.extensions['query_stats'] = app.config.get(
+            'DB_SLOW_QUERY_THRESHOLD', 0.5)
+        if not event.contains(Engine, 'before_cursor_execute',
+                              before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute',
+                         before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+        app.before_request(self.start)
+        app.after_request(self.finish)
+
+    @staticmethod
+    def start():
+        g.query_stats = {
+            'count': 0, 'time': 0.0, 'start': time.perf_counter(),
+            'threshold': current_app.extensions['query_stats']}
+
+    @staticmethod
+    def finish(rv):
+        stats = g.pop('query_stats', None)
+        if stats is not None:
+            total = time.perf_counter() - stats['start']
+            g.setdefault('headers', {})['Server-Timing'] = \
+                'db;desc="%d queries";dur=%.1f, app;dur=%.1f' % (
+                    stats['count'], stats['time'] * 1000, total * 1000)
+        return rv
@@ -1,14 +1,18 @@
+import threading
+import time
+from collections import namedtuple
 from datetime import datetime
 from dateutil import parser as datetime_parser
 from dateutil.tz import tzutc
-from werkzeug.security import generate_password_hash, check_password_hash
 from itsdangerous import JSONWebSignatureSerializer as Serializer
 from flask import url_for, current_app, g
-from . import db, create_app
+from sqlalchemy import event, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
+from . import db, hasher, serializers
+from .cache import TTLCache
 from .exceptions import ValidationError
 from .utils import split_url
-import flask_whooshalchemy as whooshalchemy
-from whoosh.analysis import StemmingAnalyzer
 
 
 
@@ -20,6 +24,69 @@ class Permission:
     ADMINISTER = 0x80
 
 
+RoleInfo = namedtuple('RoleInfo', ['id', 'name', 'permissions', 'default'])
+
+
+class RoleRegistry(object):
+    """Process wide, read only copy of the roles table.
+
+    Roles are a handful of rows that almost never change, so they are read
+    once and then served from memory. The registry is reloaded after
+    ``Role.insert_roles`` runs, dropped whenever a role is written through
+    the ORM, and refreshed every ``ttl`` seconds to pick up changes made by
+    other processes."""
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        # (by_id, by_name, default), replaced as a whole so that readers
+        # never see a half cleared registry
+        self._roles = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        by_id = {}
+        by_name = {}
+        default = None
+        for role in Role.query.all():
+            info = RoleInfo(role.id, role.name, role.permissions, role.default)
+            by_id[info.id] = info
+            by_name[info.name] = info
+            if info.default:
+                default = info
+        roles = (by_id, by_name, default)
+        with self._lock:
+            self._roles = roles
+            self._loaded_at = time.monotonic()
+        return roles
+
+    def clear(self):
+        with self._lock:
+            self._roles = None
+
+    def _snapshot(self):
+        with self._lock:
+            roles, loaded_at = self._roles, self._loaded_at
+        if roles is None or time.monotonic() - loaded_at > self.ttl:
+            roles = self.load()
+        return roles
+
+    def get(self, name):
+        return self._snapshot()[1].get(name)
+
+    def get_id(self, name):
+        role = self.get(name)
+        return role.id if role is not None else None
+
+    def by_id(self, id):
+        return self._snapshot()[0].get(id)
+
+    def default(self):
+        return self._snapshot()[2]
+
+
+registry = RoleRegistry()
+
+
 class Role(db.Model):
     __tablename__ = 'roles'
     id = db.Column(db.Integer, primary_key=True)
@@ -43,19 +110,43 @@ class Role(db.Model):
             role.default = roles[r][1]
             db.session.add(role)
         db.session.commit()
+        registry.load()
 
     def __repr__(self):
         return '<Role %r>' % self.name
 
 
+@event.listens_for(Role, 'after_insert')
+@event.listens_for(Role, 'after_update')
+@event.listens_for(Role, 'after_delete')
+def _role_changed(mapper, connection, target):
+    registry.clear()
+
+
+
+# per process caches used to authenticate requests without going to the
+# database: verified tokens map to user ids, and user ids map to detached
+# snapshots of the user row
+_serializers = {}
+_token_cache = TTLCache(maxsize=4096, ttl=3600)
+_user_cache = TTLCache(maxsize=1024, ttl=300)
+
+
+def get_serializer(secret_key):
+    """Return the token serializer for a secret key, creating it once."""
+    s = _serializers.get(secret_key)
+    if s is None:
+        s = _serializers[secret_key] = Serializer(secret_key)
+    return s
+
 
 class User(db.Model):
     __tablename__ = 'users'
     __searchable__ = ['name', 'company', 'email', 'position', 'location', 'about'] 
-    __analyzer__ = StemmingAnalyzer()
+    __search_filters__ = ['role_id']
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(64), index=True)
-    role_id = db.Column(db.Integer, db.ForeignKey('roles.id'))
+    role_id = db.Column(db.Integer, db.ForeignKey('roles.id'), index=True)
     password_hash = db.Column(db.String(128))
     confirmed = db.Column(db.Boolean, default=True)
     name = db.Column(db.String(64))
@@ -66,6 +157,7 @@ class User(db.Model):
     about = db.Column(db.Text())
     member_since = db.Column(db.DateTime(), default=datetime.utcnow)
     last_seen = db.Column(db.DateTime(), default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime(), default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     feeds = db.relationship('Feed', backref='author', lazy='dynamic')
     comments = db.relationship('Comment', backref='author', lazy='dynamic')
     likes = db.relationship('Like', backref='liker', lazy='dynamic')
@@ -76,33 +168,82 @@ class User(db.Model):
 
     def __init__(self, **kwargs):
         super(User, self).__init__(**kwargs)
-        if self.role is None:
-            if self.role is None:
-                self.role = Role.query.filter_by(default=True).first()
+        if self.role is None and self.role_id is None:
+            default = registry.default()
+            if default is not None:
+                self.role_id = default.id
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hasher.hash(password)
 
     def verify_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return hasher.check(self.password_hash, password)
+
+    def upgrade_password(self, password):
+        """Hash a verified password again if the cost parameters changed
+        since its hash was made. Returns True when the hash was replaced,
+        which the caller has to commit."""
+        if not hasher.needs_rehash(self.password_hash):
+            return False
+        self.password_hash = hasher.hash(password)
+        return True
 
     def generate_auth_token(self):
-        s = Serializer(current_app.config['SECRET_KEY'])
+        s = get_serializer(current_app.config['SECRET_KEY'])
         return s.dumps({'id': self.id}).decode('utf-8')
 
+    @staticmethod
+    def get_token_id(token):
+        """Return the id of the user a token was issued to, or None if the
+        token is invalid, without loading the user."""
+        id = _token_cache.get(token)
+        if id is None:
+            s = get_serializer(current_app.config['SECRET_KEY'])
+            try:
+                data = s.loads(token)
+            except:
+                return None
+            id = data['id']
+            _token_cache.set(token, id)
+        return id
+
     @staticmethod
     def verify_auth_token(token):
-        s = Serializer(current_app.config['SECRET_KEY'])
-        try:
-            data = s.loads(token)
-        except:
+        id = User.get_token_id(token)
+        if id is None:
             return None
-        return User.query.get(data['id'])
-    
+        snapshot = _user_cache.get(id)
+        if snapshot is None:
+            user = User.query.get(id)
+            if user is not None:
+                _user_cache.set(id, user.snapshot())
+            return user
+        # attach a copy of the snapshot to this request's session, which
+        # does not issue any queries
+        return db.session.merge(snapshot, load=False)
+
+    def snapshot(self):
+        """Return a detached copy of this user's columns, suitable for
+        caching across requests."""
+        snapshot = User.__mapper__.class_manager.new_instance()
+        for attr in inspect(User).column_attrs:
+            setattr(snapshot, attr.key, getattr(self, attr.key))
+        make_transient_to_detached(snapshot)
+        return snapshot
+
+    @staticmethod
+    def invalidate_auth_cache(id):
+        _user_cache.delete(id)
+
+    @staticmethod
+    def get_version(id):
+        return db.session.query(User.updated_at).filter(User.id == id).scalar()
+
 
     def can(self, permissions):
-        return self.role is not None and \
-            (self.role.permissions & permissions) == permissions
+        role = registry.by_id(self.role_id)
+        return role is not None and \
+            (role.permissions & permissions) == permissions
 
     def is_administrator(self):
         return self.can(Permission.ADMINISTER)
@@ -110,28 +251,8 @@ class User(db.Model):
     def get_url(self):
         return url_for('api.get_user', id=self.id, _external=True)
 
-    def get_image_url(self):
-        if self.image is None:
-            return 'false'
-        return url_for('static', filename='images/users/'+self.image, _external=True)
-
     def export_data(self):
-        return {
-            'id': self.id,
-            'self_url': self.get_url(),
-            'role_id': self.role_id,
-            'email': self.email,
-            'name': self.name,
-            'image': self.get_image_url(),
-            'location': self.location,
-            'company': self.company,
-            'position': self.position,
-            'about': self.about,
-            'feeds_url': url_for('api.get_feeds', id=self.id, _external=True),
-            'comments_url': url_for('api.get_feed_comments', id=self.id, _external=True),
-            'sent_messages_url': url_for('api.get_outbox', id=self.id, _external=True),
-            'received_messages_url': url_for('api.get_inbox', id=self.id, _external=True)
-        }
+        return serializers.user(self, serializers.urls())
 
     def import_data(self, data):
         try:
@@ -151,13 +272,51 @@ class User(db.Model):
         return '<User %r>' % self.username
 
 
+def load_users(ids):
+    """Return a dictionary with the users that have the given ids, loaded
+    with a single query."""
+    ids = set(id for id in ids if id is not None)
+    if not ids:
+        return {}
+    return dict((user.id, user) for user in User.query.filter(User.id.in_(ids)))
+
+
+def users_version():
+    """Return a scalar subquery with the high-water mark of the users table,
+    for the versions of resources that embed user details."""
+    return db.select([db.func.max(User.updated_at)]).as_scalar()
+
+
+@event.listens_for(User, 'after_insert')
+def _user_created(mapper, connection, target):
+    # new users start with empty message counters, so that reading them
+    # never has to create them
+    connection.execute(MessageCounter.__table__.insert().values(
+        user_id=target.id, unread=0, received=0, sent=0))
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _user_changed(mapper, connection, target):
+    # any write to a user, including a role change, drops its cached
+    # snapshot in this process
+    User.invalidate_auth_cache(target.id)
+
+
 class Feed(db.Model):
     __tablename__ = 'feeds'
+    __table_args__ = (
+        db.Index('ix_feeds_author_timestamp', 'author_id', 'timestamp'),
+    )
+    __searchable__ = ['title', 'body']
     id = db.Column(db.Integer, primary_key=True)
-    title = db.Column(db.String(1024), index=True)
+    title = db.Column(db.String(1024))
     body = db.Column(db.Text)
     image = db.Column(db.String(1024), index=True)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    like_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    comment_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
     likes = db.relationship('Like', backref='feed', lazy='dynamic')
     author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     comments = db.relationship('Comment', backref='feed', lazy='dynamic')
@@ -166,35 +325,51 @@ class Feed(db.Model):
     def get_url(self):
         return url_for('api.get_feed', id=self.id, _external=True)
 
-    def get_image_url(self):
-        if self.image is None:
-            return 'false'
-        else:
-            return url_for('static', filename='images/feeds/'+self.image, _external=True)
+    def export_data(self, author=None):
+        if author is None:
+            author = self.author
+        return serializers.feed(self, author, serializers.urls())
 
-    def get_author_image(self):
-        if self.author.image is None:
-            return 'false'
-        else:
-            return url_for('static', filename='images/users/'+self.author.image, _external=True)
+    @staticmethod
+    def export_collection(feeds):
+        """Export a page of feeds with a single extra query that loads all
+        their authors. Like and comment counts come from the counter
+        columns."""
+        if not feeds:
+            return []
+        authors = load_users(feed.author_id for feed in feeds)
+        urls = serializers.urls()
+        return [serializers.feed(feed, authors.get(feed.author_id), urls)
+                for feed in feeds]
 
-    def export_data(self):
-        return {
-            'id': self.id,
-            'likes': self.likes.count(),
-            'comments': self.comments.count(),
-            'self_url': self.get_url(),
-            'author_id': self.author.id,
-            'author_name': self.author.name,
-            'author_image': self.get_author_image(),
-            'author_company': self.author.company,
-            'author_position': self.author.position,
-            'title': self.title,
-            'body': self.body,
-            'created_on': self.timestamp,
-            'image': self.get_image_url(),
-            'comments_url': url_for('api.get_feed_comments', id=self.id, _external=True)
-        }
+    @staticmethod
+    def get_version(id):
+        return db.session.query(Feed.updated_at, users_version()) \
+            .filter(Feed.id == id).first()
+
+    @staticmethod
+    def get_collection_version():
+        return db.session.query(db.func.max(Feed.updated_at),
+                                users_version()).first()
+
+    @staticmethod
+    def get_author_version(id):
+        return db.session.query(db.func.max(Feed.updated_at),
+                                users_version()) \
+            .filter(Feed.author_id == id).first()
+
+    @staticmethod
+    def rebuild_counters():
+        """Recompute the like and comment counters of every feed from the
+        likes and comments tables."""
+        likes = db.select([db.func.count(Like.id)]) \
+            .where(Like.feed_id == Feed.id).as_scalar()
+        comments = db.select([db.func.count(Comment.id)]) \
+            .where(Comment.feed_id == Feed.id).as_scalar()
+        Feed.query.update({Feed.like_count: likes,
+                           Feed.comment_count: comments},
+                          synchronize_session=False)
+        db.session.commit()
 
     def import_data(self, data):
         try:
@@ -219,20 +394,18 @@ class Comment(db.Model):
         return url_for('api.get_comment', id=self.id, _external=True)
 
 
-    def get_author_image(self):
-        if self.author.image is None:
-            return 'false'
-        return url_for('static', filename='images/users/'+self.author.image, _external=True)
-
-
     def export_data(self):
-        return {
-            'body': self.body,
-            'author_image': self.get_author_image(),
-            'author_name': self.author.name,
-            'author_id': self.author.id,
-            'created_on': self.timestamp
-        }
+        return serializers.comment(self, self.author, serializers.urls())
+
+    @staticmethod
+    def export_collection(comments):
+        """Export a list of comments, loading all their authors with a
+        single query."""
+        authors = load_users(comment.author_id for comment in comments)
+        urls = serializers.urls()
+        return [serializers.comment(comment, authors.get(comment.author_id),
+                                    urls)
+                for comment in comments]
 
 
     def import_data(self, data):
@@ -244,6 +417,7 @@ class Comment(db.Model):
 
 
 class Like(db.Model):
+    __table_args__ = (db.UniqueConstraint('user_id', 'feed_id'),)
     id = db.Column(db.Integer(), primary_key=True, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     feed_id = db.Column(db.Integer, db.ForeignKey('feeds.id'))
@@ -252,11 +426,16 @@ class Like(db.Model):
 
 class Message(db.Model):
     __tablename__ = 'messages'
+    __table_args__ = (
+        db.Index('ix_messages_receiver_read_created', 'receiver_id', 'read', 'created_on'),
+        db.Index('ix_messages_sender_created', 'sender_id', 'created_on'),
+    )
     id = db.Column(u'id', db.Integer(), primary_key=True, nullable=False)
     title = db.Column(db.String(256), index=True)
-    body = db.Column(db.Text(), index=True)
+    body = db.Column(db.Text())
     read = db.Column(db.Boolean, default=False)
     created_on = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     sender_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     receiver_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     replies = db.relationship('Reply', backref='message', lazy='dynamic')
@@ -264,35 +443,56 @@ class Message(db.Model):
     def get_url(self):
         return url_for('api.get_message', id=self.id, _external=True)
 
-    def get_author_image(self, id):
-        user = User.query.get_or_404(id)
-        if user.image is None:
-            return 'false'
-        return url_for('static', filename='images/users/'+user.image, _external=True)
+    @staticmethod
+    def get_version(id, user_id):
+        """Return the version of a message and its replies, as seen by its
+        receiver."""
+        reply_count = db.select([db.func.count(Reply.id)]) \
+            .where(Reply.message_id == id).as_scalar()
+        reply_time = db.select([db.func.max(Reply.updated_at)]) \
+            .where(Reply.message_id == id).as_scalar()
+        return db.session.query(Message.updated_at, reply_count, reply_time,
+                                users_version()) \
+            .filter(Message.id == id, Message.receiver_id == user_id).first()
+
+    @staticmethod
+    def get_inbox_version(user_id):
+        return db.session.query(db.func.count(Message.id),
+                                db.func.max(Message.updated_at),
+                                users_version()) \
+            .filter(Message.receiver_id == user_id).first()
+
+    @staticmethod
+    def get_outbox_version(user_id):
+        return db.session.query(db.func.count(Message.id),
+                                db.func.max(Message.updated_at),
+                                users_version()) \
+            .filter(Message.sender_id == user_id).first()
 
     def is_me(self):
-        if self.sender == g.user:
+        if self.sender_id == g.user.id:
             return True
         return False
     
     def is_mine(self):
-        if self.receiver == g.user:
+        if self.receiver_id == g.user.id:
             return True
         return False
 
-    def export_data(self):
-        return {
-            'id': self.id,
-            'isMe': self.is_me(),
-            'title': self.title,
-            'body': self.body,
-            'created_on': self.created_on,
-            'read': self.read,
-            'sender_id': self.sender_id,
-            'receiver_id': self.receiver_id,
-            'sender_image': self.get_author_image(self.sender_id),
-            'receiver_image': self.get_author_image(self.receiver_id),
-        }
+    def export_data(self, users=None):
+        if users is None:
+            users = load_users([self.sender_id, self.receiver_id])
+        return serializers.message(self, users, serializers.urls())
+
+    @staticmethod
+    def export_collection(messages):
+        """Export a page of messages, loading all the senders and receivers
+        with a single query."""
+        users = load_users([message.sender_id for message in messages] +
+                           [message.receiver_id for message in messages])
+        urls = serializers.urls()
+        return [serializers.message(message, users, urls)
+                for message in messages]
 
 
     def import_data(self, data):
@@ -302,14 +502,93 @@ class Message(db.Model):
             self.receiver_id = data['receiver_id']
         except KeyError as e:
             raise ValidationError('Parameters missing ' + e.args[0])
+        if not isinstance(self.receiver_id, int) or \
+                db.session.query(User.id).filter_by(
+                    id=self.receiver_id).first() is None:
+            raise ValidationError('Invalid receiver: %r' % (self.receiver_id,))
         return self
 
 
+class MessageCounter(db.Model):
+    """Per user message counters, kept up to date by the message routes so
+    that polling clients can read them without counting messages."""
+    __tablename__ = 'message_counters'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    unread = db.Column(db.Integer, default=0, nullable=False)
+    received = db.Column(db.Integer, default=0, nullable=False)
+    sent = db.Column(db.Integer, default=0, nullable=False)
+
+    @staticmethod
+    def count(user_id):
+        """Return new counters for a user, computed from the messages
+        table."""
+        received = Message.query.filter_by(receiver_id=user_id)
+        return MessageCounter(
+            user_id=user_id,
+            unread=received.filter(db.or_(Message.read == False,
+                                          Message.read == None)).count(),
+            received=received.count(),
+            sent=Message.query.filter_by(sender_id=user_id).count())
+
+    @staticmethod
+    def get(user_id):
+        """Return the counters of a user, creating them on first use."""
+        counter = MessageCounter.query.get(user_id)
+        if counter is None:
+            counter = MessageCounter.count(user_id)
+            db.session.add(counter)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # a concurrent request created them first
+                db.session.rollback()
+                counter = MessageCounter.query.get(user_id)
+        return counter
+
+    @staticmethod
+    def ensure(user_id):
+        """Create the counters of a user that has none, as part of the
+        current transaction. Counters are computed from the messages table,
+        so this has to run before a change that the counters account
+        for."""
+        if MessageCounter.query.get(user_id) is None:
+            try:
+                with db.session.begin_nested():
+                    db.session.add(MessageCounter.count(user_id))
+            except IntegrityError:
+                # a concurrent request created them first
+                pass
+
+    @staticmethod
+    def update(user_id, **deltas):
+        """Add the given deltas to a user's counters, as part of the current
+        transaction. This must be called before the change it accounts for
+        is made, or after ``ensure``, because counters that do not exist yet
+        are first computed from the messages table."""
+        values = dict((getattr(MessageCounter, name),
+                       getattr(MessageCounter, name) + delta)
+                      for name, delta in deltas.items() if delta)
+        if not values:
+            return
+        MessageCounter.ensure(user_id)
+        MessageCounter.query.filter_by(user_id=user_id) \
+            .update(values, synchronize_session=False)
+
+    @staticmethod
+    def rebuild():
+        """Recompute the counters of every user."""
+        MessageCounter.query.delete()
+        for (user_id,) in db.session.query(User.id):
+            db.session.add(MessageCounter.count(user_id))
+        db.session.commit()
+
+
 class Reply(db.Model):
     __tablename__ = 'replies'
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     message_id = db.Column(db.Integer, db.ForeignKey('messages.id'))
 
@@ -317,14 +596,8 @@ class Reply(db.Model):
     def get_url(self):
         return url_for('api.get_reply', id=self.id, _external=True)
 
-    def get_author_image(self, id):
-        user = User.query.get_or_404(id)
-        if user.image is None:
-            return 'false'
-        return url_for('static', filename='images/users/'+user.image, _external=True)
-
     def is_me(self):
-        if self.author == g.user:
+        if self.author_id == g.user.id:
             return True
         return False
     
@@ -333,16 +606,18 @@ class Reply(db.Model):
             return True
         return False
 
-    def export_data(self):
-        return {
-            'id': self.id,
-            'isMe': self.is_me(),
-            'body': self.body,
-            'timestamp': self.timestamp,
-            'author_id': self.author_id,
-            'message_id': self.message_id,
-            'sender_image': self.get_author_image(self.author_id),
-        }
+    def export_data(self, users=None):
+        if users is None:
+            users = load_users([self.author_id])
+        return serializers.reply(self, users, serializers.urls())
+
+    @staticmethod
+    def export_collection(replies):
+        """Export a list of replies, loading all their authors with a single
+        query."""
+        users = load_users(reply.author_id for reply in replies)
+        urls = serializers.urls()
+        return [serializers.reply(reply, users, urls) for reply in replies]
 
 
     def import_data(self, data):
@@ -351,6 +626,3 @@ class Reply(db.Model):
         except KeyError as e:
             raise ValidationError('Invalid customer: missing ' + e.args[0])
         return self
-
-app = create_app('production')
-whooshalchemy.search_index(app, User)
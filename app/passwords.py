@@ -0,0 +1,102 @@
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, \
+    generate_password_hash, check_password_hash
+
+
+class HasherBusy(Exception):
+    """Raised when too many password operations are already waiting."""
+
+
+def stored_method(method):
+    """Return a hash method the way Werkzeug writes it into the hashes it
+    makes, where PBKDF2 always carries its number of iterations."""
+    if method.startswith('pbkdf2:'):
+        args = method[7:].split(':')
+        iterations = len(args) > 1 and int(args[1] or 0) or \
+            DEFAULT_PBKDF2_ITERATIONS
+        return 'pbkdf2:%s:%d' % (args[0], iterations)
+    return method
+
+
+class PasswordHasher(object):
+    """Hashes and checks passwords in a bounded pool of worker threads.
+
+    PBKDF2 runs in OpenSSL with the GIL released, so ``PASSWORD_WORKERS``
+    threads hash in parallel while the threads serving other requests keep
+    running. At most ``PASSWORD_QUEUE_SIZE`` operations wait for a worker;
+    once the queue is full, callers wait up to ``PASSWORD_QUEUE_TIMEOUT``
+    seconds for a place and then get ``HasherBusy``, which the API turns
+    into a 503, instead of piling up behind a login burst.
+
+    ``PASSWORD_HASH_METHOD`` and ``PASSWORD_SALT_LENGTH`` set the cost of
+    new hashes, in Werkzeug's format, for example
+    ``'pbkdf2:sha256:150000'``. Hashes made with other parameters still
+    verify, and ``needs_rehash`` tells when they should be replaced."""
+    def __init__(self, app=None):
+        self.method = 'pbkdf2:sha256:150000'
+        self.salt_length = 8
+        self.workers = 2
+        self.queue_size = 64
+        self.timeout = 5
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.method = stored_method(app.config.get('PASSWORD_HASH_METHOD',
+                                                   self.method))
+        self.salt_length = app.config.get('PASSWORD_SALT_LENGTH',
+                                          self.salt_length)
+        self.workers = app.config.get('PASSWORD_WORKERS', self.workers)
+        self.queue_size = app.config.get('PASSWORD_QUEUE_SIZE',
+                                         self.queue_size)
+        self.timeout = app.config.get('PASSWORD_QUEUE_TIMEOUT', self.timeout)
+        self._executor = None
+        app.extensions['passwords'] = self
+
+    @property
+    def executor(self):
+        # created on first use, so that each worker process gets its own
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._slots = threading.BoundedSemaphore(
+                        self.workers + self.queue_size)
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.workers)
+        return self._executor
+
+    def run(self, fn, *args):
+        executor = self.executor
+        if not self._slots.acquire(timeout=self.timeout):
+            raise HasherBusy('Too many password operations in progress')
+        try:
+            return executor.submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    @property
+    def hash_function(self):
+        """A picklable function that hashes a password with the current
+        parameters, for use in process pools."""
+        return functools.partial(generate_password_hash, method=self.method,
+                                 salt_length=self.salt_length)
+
+    def hash(self, password):
+        return self.run(self.hash_function, password)
+
+    def check(self, pwhash, password):
+        if not pwhash:
+            return False
+        return self.run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        parts = pwhash.split('$')
+        if len(parts) != 3 or parts[0] != self.method:
+            return True
+        # plain text "hashes" have no salt
+        return self.method != 'plain' and len(parts[1]) != self.salt_length
@@ -0,0 +1,275 @@
+import hashlib
+import logging
+import math
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+from flask import current_app, g, jsonify, request
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryStore(object):
+    """Rate limit state kept in a dictionary of the current process."""
+    def __init__(self, cleanup=10000):
+        self.cleanup = cleanup
+        self._data = {}
+        self._added = 0
+        self._lock = threading.Lock()
+
+    def update(self, key, fn):
+        """Replace the value of a key with ``fn(old_value)[0]`` atomically,
+        and return ``fn(old_value)[1]``. The old value is None for a new
+        key."""
+        with self._lock:
+            old = self._data.get(key)
+            value, result = fn(old)
+            self._data[key] = value
+            if old is None:
+                self._added += 1
+                if self._added >= self.cleanup:
+                    # drop the buckets that are full again
+                    now = time.time()
+                    self._data = dict((k, v) for k, v in self._data.items()
+                                      if v > now)
+                    self._added = 0
+            return result
+
+    def get(self, key):
+        with self._lock:
+            return self._data.get(key)
+
+
+class MmapStore(object):
+    """Rate limit state shared by all the processes that map the same file.
+
+    The file is a fixed size hash table of ``slots`` entries, each holding
+    a key hash and a timestamp, updated under an exclusive ``flock``. When
+    the slots a key can use are all taken, the one that expired first is
+    reused, which at worst forgets an old client."""
+    entry = struct.Struct('<Qd')
+    probes = 8
+
+    def __init__(self, path, slots=65536):
+        self.path = path
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _open(self):
+        # the mapping is created on first use, so that every worker process
+        # gets its own after forking
+        size = self.slots * self.entry.size
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._pid = os.getpid()
+
+    @staticmethod
+    def _hash(key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'little') or 1
+
+    def get(self, key):
+        h = self._hash(key)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_SH)
+            try:
+                for i in range(self.probes):
+                    offset = (h + i) % self.slots * self.entry.size
+                    stored, value = self.entry.unpack_from(self._map, offset)
+                    if stored == h:
+                        return value
+                    if stored == 0:
+                        return None
+                return None
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def update(self, key, fn):
+        h = self._hash(key)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                slot = None
+                oldest = None
+                for i in range(self.probes):
+                    offset = (h + i) % self.slots * self.entry.size
+                    stored, value = self.entry.unpack_from(self._map, offset)
+                    if stored == h:
+                        slot = offset
+                        break
+                    if stored == 0:
+                        slot, value = offset, None
+                        break
+                    if oldest is None or value < oldest[1]:
+                        oldest = (offset, value)
+                if slot is None:
+                    slot, value = oldest[0], None
+                value, result = fn(value)
+                self.entry.pack_into(self._map, slot, h, value)
+                return result
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+class SQLiteStore(object):
+    """Rate limit state shared by all the processes that open the same
+    SQLite database file."""
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('CREATE TABLE IF NOT EXISTS ratelimit '
+                         '(key TEXT PRIMARY KEY, value REAL) WITHOUT ROWID')
+            self._local.connection = conn
+        return conn
+
+    def update(self, key, fn):
+        conn = self.connection
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT value FROM ratelimit WHERE key = ?',
+                               (key,)).fetchone()
+            value, result = fn(row[0] if row is not None else None)
+            conn.execute('INSERT OR REPLACE INTO ratelimit (key, value) '
+                         'VALUES (?, ?)', (key, value))
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        return result
+
+    def get(self, key):
+        row = self.connection.execute(
+            'SELECT value FROM ratelimit WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+
+def get_store(app, prefix='RATELIMIT'):
+    """Return the store named by the ``<prefix>_STORE`` configuration
+    variable, with its file at ``<prefix>_STORE_PATH``. Stores map string
+    keys to timestamps, so they are also used for other short lived state
+    that the workers of a host share."""
+    store = app.config.get(prefix + '_STORE', 'memory')
+    if callable(store):
+        return store(app)
+    if store == 'memory':
+        return MemoryStore()
+    if store == 'mmap' and fcntl is None:
+        # no flock on this platform, share the state through SQLite instead
+        path = os.path.splitext(app.config[prefix + '_STORE_PATH'])[0] + \
+            '.sqlite'
+        logger.warning('The mmap store needs fcntl, using an SQLite store '
+                       'at %s instead', path)
+        return SQLiteStore(path)
+    if store == 'mmap':
+        return MmapStore(app.config[prefix + '_STORE_PATH'])
+    if store == 'sqlite':
+        return SQLiteStore(app.config[prefix + '_STORE_PATH'])
+    raise ValueError('Unknown store: ' + store)
+
+
+class RateLimiter(object):
+    """Token bucket rate limiter.
+
+    Each client has a bucket of ``limit`` requests that refills at a rate
+    of ``limit`` requests per ``period`` seconds, implemented as the
+    generic cell rate algorithm, so the whole state of a bucket is a single
+    timestamp. Clients are identified by the user of their token when they
+    send one, or else by their address.
+
+    ``RATELIMIT_DEFAULT`` is the ``(limit, period)`` budget shared by all
+    the routes that are rate limited, ``RATELIMIT_ENDPOINTS`` maps
+    endpoints to budgets of their own, and ``RATELIMIT_USERS`` maps user
+    ids to budgets that replace both. The state lives in the store named by
+    ``RATELIMIT_STORE``: ``'memory'`` (the default, per process),
+    ``'mmap'`` or ``'sqlite'`` for a file at ``RATELIMIT_STORE_PATH``
+    shared by all the workers of a host (``'mmap'`` falls back to SQLite,
+    next to that path, where ``fcntl`` is not available), or a callable that takes the
+    application and returns an object with the same ``update`` and ``get``
+    methods.
+    Set ``RATELIMIT_ENABLED`` to False to turn limiting off."""
+    def __init__(self, app=None):
+        self.store = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.store = get_store(app)
+        app.extensions['ratelimit'] = self
+
+    @staticmethod
+    def identity():
+        from .models import User
+        auth = request.authorization
+        if auth is not None and auth.username:
+            id = User.get_token_id(auth.username)
+            if id is not None:
+                return id, 'user:%d' % id
+        return None, 'addr:%s' % request.remote_addr
+
+    def check(self):
+        """Count a request against its client's budget. Returns a 429
+        response when the budget is exhausted, and None otherwise."""
+        config = current_app.config
+        if not config.get('RATELIMIT_ENABLED', True):
+            return None
+        user_id, key = self.identity()
+        endpoints = config.get('RATELIMIT_ENDPOINTS') or {}
+        users = config.get('RATELIMIT_USERS') or {}
+        if user_id in users:
+            limit, period = users[user_id]
+        elif request.endpoint in endpoints:
+            limit, period = endpoints[request.endpoint]
+            key += ':' + request.endpoint
+        else:
+            limit, period = config.get('RATELIMIT_DEFAULT', (20, 15))
+
+        now = time.time()
+        interval = period / float(limit)
+
+        def hit(tat):
+            tat = max(tat or now, now)
+            if tat + interval - now > period:
+                return tat, (False, tat)
+            return tat + interval, (True, tat + interval)
+        allowed, tat = self.store.update(key, hit)
+
+        remaining = int((period - (tat - now)) / interval + 1e-9) \
+            if allowed else 0
+        g.headers = {
+            'X-RateLimit-Limit': str(limit),
+            'X-RateLimit-Remaining': str(remaining),
+            'X-RateLimit-Reset': str(int(math.ceil(tat)))
+        }
+        if not allowed:
+            response = jsonify({'status': 429, 'error': 'too many requests',
+                                'message': 'You have exceeded your request '
+                                           'rate'})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(
+                int(math.ceil(tat + interval - period - now)))
+            return response
+        return None
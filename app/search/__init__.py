@@ -0,0 +1,262 @@
+import atexit
+import logging
+import threading
+import time
+from datetime import datetime
+from flask import current_app
+from flask_sqlalchemy import models_committed
+
+logger = logging.getLogger(__name__)
+
+
+def get_engine_class(name):
+    """Return the search engine class configured by name. Engines are
+    imported on demand, so only the libraries of the engine in use need to
+    be installed."""
+    if not isinstance(name, str):
+        return name
+    if name == 'fts5':
+        from .fts5_engine import FTS5Engine
+        return FTS5Engine
+    if name == 'whoosh':
+        from .whoosh_engine import WhooshEngine
+        return WhooshEngine
+    raise ValueError('Unknown search engine: ' + name)
+
+
+class BatchWriter(object):
+    """Collects index changes and applies them to the engines in batches.
+
+    Changes are flushed from a background thread every ``interval``
+    seconds, or sooner once ``size`` changes are pending. Repeated changes
+    to the same row between two flushes are merged, so only its latest
+    version is written. The thread is started on first use, so each worker
+    process gets its own, and pending changes are flushed at exit.
+
+    Changes that cannot be written are kept for the next flush, and the
+    thread then waits twice as long after every failed flush, up to
+    ``max_backoff`` seconds, before trying again. ``failures`` counts the
+    failed flushes and ``pending`` the changes waiting to be written."""
+    def __init__(self, engines, interval, size, max_backoff=60):
+        self.engines = engines
+        self.interval = interval
+        self.size = size
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self._pending = {}
+        self._count = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def add(self, table, id, doc):
+        """Queue a document for indexing, or its removal if doc is None."""
+        with self._lock:
+            changes = self._pending.setdefault(table, {})
+            if id not in changes:
+                self._count += 1
+            changes[id] = doc
+            count = self._count
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run,
+                                                name='search-index-writer')
+                self._thread.daemon = True
+                self._thread.start()
+                atexit.register(self.flush)
+        if count >= self.size:
+            self._wakeup.set()
+
+    @property
+    def pending(self):
+        return self._count
+
+    def flush(self):
+        """Write the pending changes. The changes of a table that fail to
+        be written are queued again, unless the same rows changed since,
+        and the first error is raised once every table was tried."""
+        with self._lock:
+            pending, self._pending, self._count = self._pending, {}, 0
+        error = None
+        for table, changes in pending.items():
+            engine = self.engines[table]
+            deleted = [id for id, doc in changes.items() if doc is None]
+            docs = [doc for doc in changes.values() if doc is not None]
+            try:
+                if deleted:
+                    engine.delete(deleted)
+                if docs:
+                    engine.update(docs)
+            except Exception as e:
+                self.requeue(table, changes)
+                if error is None:
+                    error = e
+        if error is not None:
+            with self._lock:
+                self.failures += 1
+            raise error
+
+    def requeue(self, table, changes):
+        with self._lock:
+            pending = self._pending.setdefault(table, {})
+            for id, doc in changes.items():
+                if id not in pending:
+                    pending[id] = doc
+                    self._count += 1
+
+    def run(self):
+        backoff = 0
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+                backoff = 0
+            except Exception:
+                logger.exception('Could not update the search index')
+                backoff = min(max(backoff * 2, self.interval),
+                              self.max_backoff)
+                time.sleep(backoff)
+
+
+class SearchIndex(object):
+    """Full-text search index of the searchable models.
+
+    A model is searchable when it defines a ``__searchable__`` list of text
+    columns. It can also define a ``__search_filters__`` list of columns
+    that are indexed as exact terms, so that searches can be restricted on
+    them inside the index instead of after fetching the results.
+
+    The index itself is kept by a pluggable engine, selected with the
+    ``SEARCH_ENGINE`` configuration variable: ``'fts5'`` (the default) for
+    SQLite FTS5, ``'whoosh'`` for Whoosh, or any class with the same
+    interface.
+
+    By default the index is updated in one batch every time a session
+    commits. When ``SEARCH_BATCH_INTERVAL`` is set to a number of seconds,
+    changes are instead queued and written by a background thread at that
+    interval, or every ``SEARCH_BATCH_SIZE`` changes, whichever comes
+    first. Searches can then lag behind writes by up to the interval. When
+    the index cannot be written, changes are retried with a backoff of up
+    to ``SEARCH_BATCH_MAX_BACKOFF`` seconds."""
+    def __init__(self, app=None, models=None):
+        if app is not None:
+            self.init_app(app, models)
+
+    def init_app(self, app, models):
+        engine_class = get_engine_class(app.config.get('SEARCH_ENGINE',
+                                                       'fts5'))
+        engines = {}
+        for model in models:
+            engines[model.__tablename__] = engine_class.from_config(
+                app.config, model.__tablename__, model.__searchable__,
+                getattr(model, '__search_filters__', []))
+        app.extensions['search'] = engines
+        interval = app.config.get('SEARCH_BATCH_INTERVAL')
+        if interval:
+            app.extensions['search_writer'] = BatchWriter(
+                engines, interval, app.config.get('SEARCH_BATCH_SIZE', 500),
+                app.config.get('SEARCH_BATCH_MAX_BACKOFF', 60))
+        models_committed.connect(self.on_commit, sender=app)
+
+    def get_engine(self, model):
+        return current_app.extensions['search'][model.__tablename__]
+
+    @staticmethod
+    def document(instance):
+        doc = {'id': instance.id}
+        for name in instance.__searchable__:
+            value = getattr(instance, name)
+            doc[name] = value if value is not None else ''
+        for name in getattr(instance, '__search_filters__', []):
+            doc[name] = getattr(instance, name)
+        return doc
+
+    def on_commit(self, app, changes):
+        """Apply the changes made by a session commit to the index."""
+        engines = app.extensions['search']
+        writer = app.extensions.get('search_writer')
+        updated = {}
+        deleted = {}
+        for instance, change in changes:
+            table = getattr(instance, '__tablename__', None)
+            if table not in engines:
+                continue
+            if writer is not None:
+                writer.add(table, instance.id, None if change == 'delete'
+                           else self.document(instance))
+            elif change == 'delete':
+                deleted.setdefault(table, []).append(instance.id)
+            else:
+                updated.setdefault(table, []).append(self.document(instance))
+        for table, ids in deleted.items():
+            engines[table].delete(ids)
+        for table, docs in updated.items():
+            engines[table].update(docs)
+
+    def index_rows(self, model, rows):
+        """Index rows given as dictionaries of column values, such as rows
+        inserted without the ORM, which do not send commit signals."""
+        docs = []
+        for row in rows:
+            doc = {'id': row['id']}
+            for name in model.__searchable__:
+                value = row.get(name)
+                doc[name] = value if value is not None else ''
+            for name in getattr(model, '__search_filters__', []):
+                doc[name] = row.get(name)
+            docs.append(doc)
+        if docs:
+            self.get_engine(model).update(docs)
+
+    def reindex(self, model, chunk_size=1000, procs=1):
+        """Rebuild the index of a model from the database, while the live
+        index keeps answering searches, and return the number of rows
+        indexed.
+
+        Rows are streamed in primary key order, ``chunk_size`` at a time.
+        Right before the new index is swapped in, the rows deleted since
+        they were streamed are removed from it, and the rows written since
+        the rebuild started are indexed again, found with the model's
+        ``updated_at`` column when it has one and by their new ids
+        otherwise."""
+        engine = self.get_engine(model)
+        session = model.query.session
+        started = datetime.utcnow()
+        indexed = set()
+
+        def batches():
+            last = 0
+            while True:
+                rows = model.query.filter(model.id > last) \
+                    .order_by(model.id).limit(chunk_size).all()
+                if not rows:
+                    break
+                last = rows[-1].id
+                indexed.update(row.id for row in rows)
+                yield [self.document(row) for row in rows]
+                session.expunge_all()
+
+        def catch_up():
+            ids = set(id for (id,) in session.query(model.id))
+            deleted = [id for id in indexed if id not in ids]
+            if hasattr(model, 'updated_at'):
+                rows = model.query.filter(model.updated_at >= started).all()
+            else:
+                new = sorted(ids - indexed)
+                rows = []
+                for i in range(0, len(new), chunk_size):
+                    rows.extend(model.query.filter(
+                        model.id.in_(new[i:i + chunk_size])))
+            docs = [self.document(row) for row in rows]
+            session.expunge_all()
+            return docs, deleted
+
+        engine.rebuild(batches(), procs=procs, catch_up=catch_up)
+        return len(indexed)
+
+    def search(self, model, query, filters=None, page=1, per_page=25):
+        """Search a model. Returns the ids of the matching rows on the
+        requested page, best first, and the total number of hits, which
+        the FTS5 engine stops counting at ``SEARCH_MAX_TOTAL``. Only the
+        documents that match all the given ``filters`` are scored."""
+        return self.get_engine(model).search(query, filters, page, per_page)
@@ -0,0 +1,164 @@
+import logging
+import re
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+TOKEN_RE = re.compile(r'(\w+)(\*?)', re.UNICODE)
+
+
+class FTS5Engine(object):
+    """Search engine that keeps the index of a model in an SQLite FTS5
+    table, stored in the ``SEARCH_FTS5_PATH`` database file.
+
+    Text fields are tokenized with the porter stemmer, hits are ranked with
+    BM25, and query terms that end in ``*`` match as prefixes. Filter
+    fields are indexed as extra columns that are left out of the ranking,
+    so a filter is one more term in the full-text match and is resolved
+    from the index without reading the matching rows. The file is opened
+    in WAL mode, so readers in any number of processes are not blocked by
+    the writer.
+
+    Only the requested page is ranked and returned, and hits are counted up
+    to ``max_total`` (``SEARCH_MAX_TOTAL``), so broad queries do not have
+    to visit every match."""
+    def __init__(self, path, name, fields, filters, max_total=1000):
+        self.path = path
+        self.table = name
+        self.fields = list(fields)
+        self.filters = list(filters)
+        self.max_total = max_total
+        self.rank = 'bm25(%s)' % ', '.join(['1.0'] * len(self.fields) +
+                                           ['0.0'] * len(self.filters))
+        self._local = threading.local()
+        self.create_table()
+
+    @classmethod
+    def from_config(cls, config, name, fields, filters):
+        return cls(config['SEARCH_FTS5_PATH'], name, fields, filters,
+                   config.get('SEARCH_MAX_TOTAL', 1000))
+
+    @property
+    def connection(self):
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = conn
+        return conn
+
+    def create_table(self, table=None):
+        table = table or self.table
+        columns = self.fields + self.filters
+        existing = [row[1] for row in self.connection.execute(
+            'PRAGMA table_info("%s")' % table)]
+        if existing and existing != columns:
+            logger.warning('Search index %s has an outdated schema and was '
+                           'emptied, it needs to be rebuilt', table)
+            self.connection.execute('DROP TABLE "%s"' % table)
+        self.connection.execute(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS "%s" USING fts5(%s, '
+            'tokenize="porter unicode61")' % (table, ', '.join(columns)))
+
+    def write(self, table, docs=(), deleted=()):
+        """Replace and delete documents, in the current transaction."""
+        columns = self.fields + self.filters
+        rows = []
+        for doc in docs:
+            rows.append([doc['id']] + [str(doc[name]) for name in columns])
+        conn = self.connection
+        conn.executemany('DELETE FROM "%s" WHERE rowid = ?' % table,
+                         [(id,) for id in deleted] +
+                         [(row[0],) for row in rows])
+        conn.executemany('INSERT INTO "%s" (rowid, %s) VALUES (?, %s)' %
+                         (table, ', '.join(columns),
+                          ', '.join(['?'] * len(columns))), rows)
+
+    def update(self, docs, table=None):
+        conn = self.connection
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            self.write(table or self.table, docs)
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+
+    def rebuild(self, batches, procs=1, catch_up=None):
+        """Build a new index from batches of documents and swap it in.
+
+        The new index is written to a staging table, one transaction per
+        batch so that live updates can interleave, and then renamed over
+        the live table in a single transaction. Searches keep reading the
+        old table until the swap. ``catch_up`` is called inside that
+        transaction, which holds off live writers, and returns the
+        documents written and the ids deleted while the staging table was
+        filled, which are applied to it before the swap. SQLite allows a
+        single writer, so ``procs`` is ignored."""
+        staging = self.table + '_rebuild'
+        conn = self.connection
+        conn.execute('DROP TABLE IF EXISTS "%s"' % staging)
+        self.create_table(staging)
+        for docs in batches:
+            self.update(docs, staging)
+        conn.execute('INSERT INTO "%s" ("%s") VALUES (\'optimize\')' %
+                     (staging, staging))
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if catch_up is not None:
+                docs, deleted = catch_up()
+                self.write(staging, docs, deleted)
+            conn.execute('DROP TABLE "%s"' % self.table)
+            conn.execute('ALTER TABLE "%s" RENAME TO "%s"' %
+                         (staging, self.table))
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+
+    def delete(self, ids):
+        conn = self.connection
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            self.write(self.table, deleted=ids)
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+
+    def match_expression(self, query, filters):
+        """Convert a user query to an FTS5 expression that matches all its
+        words in the text fields, plus the exact value of each filter. All
+        words and values are quoted, so they cannot inject operators."""
+        terms = ['"%s"%s' % (word, prefix)
+                 for word, prefix in TOKEN_RE.findall(query)]
+        if not terms:
+            return None
+        match = '{%s} : (%s)' % (' '.join(self.fields), ' '.join(terms))
+        for name, value in (filters or {}).items():
+            if name not in self.filters:
+                raise ValueError('Unknown search filter: ' + name)
+            match += ' AND %s : "%s"' % (name, str(value).replace('"', '""'))
+        return match
+
+    def search(self, query, filters, page, per_page):
+        match = self.match_expression(query, filters)
+        if match is None:
+            return [], 0
+        conn = self.connection
+        offset = (page - 1) * per_page
+        ids = [row[0] for row in conn.execute(
+            'SELECT rowid FROM "%s" WHERE "%s" MATCH ? AND rank MATCH ? '
+            'ORDER BY rank LIMIT ? OFFSET ?' % (self.table, self.table),
+            [match, self.rank, per_page, offset])]
+        if 0 < len(ids) < per_page or not ids and offset == 0:
+            # the last page, every hit has been seen
+            return ids, offset + len(ids)
+        total = conn.execute(
+            'SELECT count(*) FROM (SELECT 1 FROM "%s" WHERE "%s" MATCH ? '
+            'LIMIT ?)' % (self.table, self.table),
+            [match, self.max_total]).fetchone()[0]
+        return ids, total
@@ -0,0 +1,131 @@
+import logging
+import os
+import shutil
+import time
+import whoosh.index
+from whoosh import fields as whoosh_fields
+from whoosh.analysis import StemmingAnalyzer
+from whoosh.qparser import AndGroup, MultifieldParser
+from whoosh.query import And, Term
+from whoosh.writing import AsyncWriter
+
+logger = logging.getLogger(__name__)
+
+
+class WhooshEngine(object):
+    """Search engine that keeps the index of a model in a Whoosh directory
+    under ``WHOOSH_INDEX_PATH``. Text fields use a stemming analyzer, and
+    filter fields are stored as exact terms.
+
+    Rebuilt indexes are written to numbered subdirectories, and the
+    ``current`` symbolic link in the directory points to the live one.
+    Indexes that were never rebuilt live in the directory itself, and are
+    left in place by the first rebuild for the processes that still have
+    them open, until they are restarted."""
+    def __init__(self, path, name, fields, filters):
+        self.path = os.path.join(path, name)
+        self.current = os.path.join(self.path, 'current')
+        self.fields = list(fields)
+        self.filters = list(filters)
+        self.index = self.open_index()
+
+    @classmethod
+    def from_config(cls, config, name, fields, filters):
+        return cls(config['WHOOSH_INDEX_PATH'], name, fields, filters)
+
+    def schema(self):
+        schema = {'id': whoosh_fields.ID(stored=True, unique=True)}
+        for name in self.fields:
+            schema[name] = whoosh_fields.TEXT(analyzer=StemmingAnalyzer())
+        for name in self.filters:
+            schema[name] = whoosh_fields.ID()
+        return whoosh_fields.Schema(**schema)
+
+    def open_index(self):
+        schema = self.schema()
+        path = self.current if os.path.lexists(self.current) else self.path
+        if whoosh.index.exists_in(path):
+            index = whoosh.index.open_dir(path)
+            if set(index.schema.names()) == set(schema.names()):
+                return index
+            logger.warning('Search index %s has an outdated schema and was '
+                           'emptied, it needs to be rebuilt', self.path)
+        elif not os.path.exists(self.path):
+            os.makedirs(self.path)
+        return whoosh.index.create_in(path, schema)
+
+    def rebuild(self, batches, procs=1, catch_up=None):
+        """Build a new index from batches of documents and swap it in.
+
+        The new index is written to a new subdirectory, with ``procs``
+        writer processes. The documents written and the ids deleted in the
+        meantime, as returned by ``catch_up``, are then applied to it, and
+        the ``current`` link is atomically repointed to it. Searches keep
+        using the old index until the swap, and the index path never goes
+        missing. The previous generation is kept, so that searches still
+        running in other processes can finish, and older ones are
+        removed."""
+        generation = str(int(time.time() * 1000))
+        target = os.path.join(self.path, generation)
+        os.makedirs(target)
+        index = whoosh.index.create_in(target, self.schema())
+        writer = index.writer(procs=procs, multisegment=procs > 1,
+                              limitmb=256)
+        for docs in batches:
+            for doc in docs:
+                writer.add_document(**dict((name, str(value))
+                                           for name, value in doc.items()))
+        writer.commit()
+
+        # live writers wait on the lock of the old index until the swap, and
+        # then write to the new one through the link
+        lock = self.index.lock('WRITELOCK')
+        lock.acquire(blocking=True)
+        try:
+            if catch_up is not None:
+                docs, deleted = catch_up()
+                with index.writer() as writer:
+                    for id in deleted:
+                        writer.delete_by_term('id', str(id))
+                    for doc in docs:
+                        writer.update_document(**dict(
+                            (name, str(value)) for name, value in doc.items()))
+            link = self.current + '.swap'
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(generation, link)
+            os.replace(link, self.current)
+        finally:
+            lock.release()
+        self.index = whoosh.index.open_dir(self.current)
+
+        # keep the live and the previous generations only
+        generations = sorted((entry for entry in os.listdir(self.path)
+                              if entry.isdigit()), key=int)
+        for entry in generations[:-2]:
+            shutil.rmtree(os.path.join(self.path, entry), ignore_errors=True)
+
+    def update(self, docs):
+        with AsyncWriter(self.index) as writer:
+            for doc in docs:
+                doc = dict((name, str(value)) for name, value in doc.items())
+                writer.update_document(**doc)
+
+    def delete(self, ids):
+        with AsyncWriter(self.index) as writer:
+            for id in ids:
+                writer.delete_by_term('id', str(id))
+
+    def search(self, query, filters, page, per_page):
+        parser = MultifieldParser(self.fields, self.index.schema,
+                                  group=AndGroup)
+        restrict = None
+        if filters:
+            restrict = And([Term(name, str(value))
+                            for name, value in filters.items()])
+        with self.index.searcher() as searcher:
+            results = searcher.search_page(parser.parse(query), page,
+                                           pagelen=per_page, filter=restrict)
+            if page > results.pagecount:
+                return [], results.total
+            return [int(hit['id']) for hit in results], results.total
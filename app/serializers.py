@@ -0,0 +1,170 @@
+from flask import abort, g, url_for
+from werkzeug.urls import url_quote
+from .images import variant_urls
+
+# stands in for an id or a filename while building URL templates, it is
+# left alone by the URL converters and cannot appear in a real URL
+PLACEHOLDER = '9876543210123456789'
+
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = (None, 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug',
+          'Sep', 'Oct', 'Nov', 'Dec')
+
+
+def http_date(value):
+    """Format a datetime the way Flask's JSON encoder does, as in
+    ``Wed, 21 Oct 2015 07:28:00 GMT``. Naive datetimes are taken as UTC."""
+    if value is None:
+        return None
+    t = value.utctimetuple()
+    return '%s, %02d %s %d %02d:%02d:%02d GMT' % (
+        WEEKDAYS[t.tm_wday], t.tm_mday, MONTHS[t.tm_mon], t.tm_year,
+        t.tm_hour, t.tm_min, t.tm_sec)
+
+
+class Urls(object):
+    """The external URLs of the current request.
+
+    ``url_for`` is called once per endpoint with a placeholder argument,
+    and the URLs of individual objects are then made by pasting their id
+    or filename in place of the placeholder. The URLs of images and of
+    their variants are also remembered, as the same authors appear many
+    times in a page."""
+    def __init__(self):
+        self._templates = {}
+        self._images = {}
+
+    def template(self, endpoint, arg):
+        key = (endpoint, arg)
+        template = self._templates.get(key)
+        if template is None:
+            url = url_for(endpoint, _external=True, **{arg: PLACEHOLDER})
+            template = self._templates[key] = tuple(url.split(PLACEHOLDER, 1))
+        return template
+
+    def endpoint(self, endpoint, id):
+        head, tail = self.template(endpoint, 'id')
+        return head + str(id) + tail
+
+    def static(self, filename):
+        head, tail = self.template('static', 'filename')
+        return head + url_quote(filename, safe='/:') + tail
+
+    def image(self, folder, imagename):
+        """Return a dictionary with the URL of an image and the URLs of its
+        variants, or ``'false'`` for all of them when there is no image."""
+        if imagename is None:
+            return NO_IMAGE
+        key = (folder, imagename)
+        urls = self._images.get(key)
+        if urls is None:
+            urls = variant_urls(folder, imagename, self.static)
+            urls['image'] = self.static(folder + imagename)
+            self._images[key] = urls
+        return urls
+
+
+NO_IMAGE = {'image': 'false', 'thumbnail': 'false', 'medium': 'false'}
+
+
+def urls():
+    """Return the URLs of the current request, created on first use."""
+    rv = g.get('urls')
+    if rv is None:
+        rv = g.urls = Urls()
+    return rv
+
+
+def user_image(user, urls):
+    return urls.image('images/users/', user.image)
+
+
+def user(user, urls):
+    images = user_image(user, urls)
+    return {
+        'id': user.id,
+        'self_url': urls.endpoint('api.get_user', user.id),
+        'role_id': user.role_id,
+        'email': user.email,
+        'name': user.name,
+        'image': images['image'],
+        'image_thumbnail': images['thumbnail'],
+        'image_medium': images['medium'],
+        'location': user.location,
+        'company': user.company,
+        'position': user.position,
+        'about': user.about,
+        'feeds_url': urls.endpoint('api.get_user_feeds', user.id),
+        'comments_url': urls.endpoint('api.get_feed_comments', user.id),
+        'sent_messages_url': urls.endpoint('api.get_outbox', user.id),
+        'received_messages_url': urls.endpoint('api.get_inbox', user.id)
+    }
+
+
+def feed(feed, author, urls):
+    images = urls.image('images/feeds/', feed.image)
+    author_images = user_image(author, urls)
+    return {
+        'id': feed.id,
+        'likes': feed.like_count,
+        'comments': feed.comment_count,
+        'self_url': urls.endpoint('api.get_feed', feed.id),
+        'author_id': author.id,
+        'author_name': author.name,
+        'author_image': author_images['image'],
+        'author_thumbnail': author_images['thumbnail'],
+        'author_company': author.company,
+        'author_position': author.position,
+        'title': feed.title,
+        'body': feed.body,
+        'created_on': http_date(feed.timestamp),
+        'image': images['image'],
+        'image_thumbnail': images['thumbnail'],
+        'image_medium': images['medium'],
+        'comments_url': urls.endpoint('api.get_feed_comments', feed.id)
+    }
+
+
+def comment(comment, author, urls):
+    return {
+        'body': comment.body,
+        'author_image': user_image(author, urls)['image'],
+        'author_name': author.name,
+        'author_id': author.id,
+        'created_on': http_date(comment.timestamp)
+    }
+
+
+def message(message, users, urls):
+    return {
+        'id': message.id,
+        'isMe': message.sender_id == g.user.id,
+        'title': message.title,
+        'body': message.body,
+        'created_on': http_date(message.created_on),
+        'read': message.read,
+        'sender_id': message.sender_id,
+        'receiver_id': message.receiver_id,
+        'sender_image': participant_image(message.sender_id, users, urls),
+        'receiver_image': participant_image(message.receiver_id, users,
+                                            urls),
+    }
+
+
+def reply(reply, users, urls):
+    return {
+        'id': reply.id,
+        'isMe': reply.author_id == g.user.id,
+        'body': reply.body,
+        'timestamp': http_date(reply.timestamp),
+        'author_id': reply.author_id,
+        'message_id': reply.message_id,
+        'sender_image': participant_image(reply.author_id, users, urls),
+    }
+
+
+def participant_image(id, users, urls):
+    user = users.get(id)
+    if user is None:
+        abort(404)
+    return user_image(user, urls)['image']
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""Concurrent write benchmark.
+
+Starts N worker processes, like N application server workers, that each
+send messages and like feeds as fast as they can against the same
+database, and reports the write throughput and the number of "database is
+locked" failures for every worker count. The default engine settings are
+compared with the tuned ones from ``config/production.py``. Run it from
+the repository root:
+
+    $ python -m bench.concurrency --workers 1 2 4 8 --ops 200
+
+A temporary SQLite database is used unless ``--database`` is given, for
+example a scratch Postgres database. Its tables are dropped and created
+again, so never point it at a database holding real data.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+from flask import Config
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+PROFILES = {
+    # Flask-SQLAlchemy defaults: a new connection per checkout on SQLite,
+    # rollback journal, and the sqlite3 module's 5 second busy timeout
+    'default': {'SQLALCHEMY_ENGINE_OPTIONS': {}, 'SQLITE_PRAGMAS': {}},
+    'tuned': None,
+}
+
+
+def make_app(database, profile, tmp):
+    from app import create_app
+    app = create_app('testing')
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI=database,
+        SERVER_NAME=None,
+        SEARCH_FTS5_PATH=os.path.join(tmp, 'search-fts5.sqlite'),
+        WHOOSH_INDEX_PATH=os.path.join(tmp, 'search'))
+    if PROFILES[profile] is None:
+        production = Config(os.getcwd())
+        production.from_pyfile(os.path.join('config', 'production.py'))
+        app.config.update(
+            SQLALCHEMY_ENGINE_OPTIONS=production['SQLALCHEMY_ENGINE_OPTIONS'],
+            SQLITE_PRAGMAS=production['SQLITE_PRAGMAS'])
+    else:
+        app.config.update(PROFILES[profile])
+    return app
+
+
+def setup(database, tmp, users, feeds):
+    from app import db
+    from app.models import Feed, Role, User
+    app = make_app(database, 'default', tmp)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        Role.insert_roles()
+        db.session.bulk_insert_mappings(User, [
+            {'id': i, 'email': 'user%d@example.com' % i, 'name': 'user%d' % i}
+            for i in range(1, users + 1)])
+        db.session.bulk_insert_mappings(Feed, [
+            {'id': i, 'title': 'feed %d' % i, 'body': 'body', 'author_id': 1}
+            for i in range(1, feeds + 1)])
+        db.session.commit()
+        if db.engine.dialect.name == 'sqlite':
+            # the journal mode is stored in the database file, start every
+            # run from the default one
+            db.session.execute('PRAGMA journal_mode = DELETE')
+        db.engine.dispose()
+
+
+def worker(args):
+    """Alternate between sending a message and liking a feed, the way the
+    new_message and like routes do, and return the number of committed
+    writes and of lock failures."""
+    database, profile, tmp, index, ops, users, feeds, start = args
+    from app import db
+    from app.models import Feed, Like, Message, MessageCounter
+    app = make_app(database, profile, tmp)
+    committed = locked = 0
+    with app.app_context():
+        while time.time() < start:
+            time.sleep(0.001)
+        for i in range(ops):
+            sender = index % users + 1
+            receiver = (index + i) % users + 1
+            try:
+                if i % 2 == 0:
+                    MessageCounter.update(sender, sent=1)
+                    MessageCounter.update(receiver, received=1, unread=1)
+                    db.session.add(Message(title='title', body='body',
+                                           sender_id=sender,
+                                           receiver_id=receiver))
+                else:
+                    feed_id = (index * ops + i) % feeds + 1
+                    db.session.add(Like(user_id=receiver, feed_id=feed_id))
+                    Feed.query.filter_by(id=feed_id).update(
+                        {Feed.like_count: Feed.like_count + 1},
+                        synchronize_session=False)
+                db.session.commit()
+                committed += 1
+            except OperationalError:
+                db.session.rollback()
+                locked += 1
+            except IntegrityError:
+                db.session.rollback()
+    return committed, locked
+
+
+def run(database, profile, tmp, workers, ops, users, feeds):
+    setup(database, tmp, users, feeds)
+    start = time.time() + 1.0
+    with multiprocessing.Pool(workers) as pool:
+        results = pool.map(worker, [
+            (database, profile, tmp, index, ops, users, feeds, start)
+            for index in range(workers)])
+    elapsed = time.time() - start
+    committed = sum(result[0] for result in results)
+    locked = sum(result[1] for result in results)
+    return {'workers': workers, 'committed': committed, 'locked': locked,
+            'seconds': round(elapsed, 3),
+            'writes_per_second': round(committed / elapsed, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', help='database URL, a temporary '
+                        'SQLite database by default')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--ops', type=int, default=200,
+                        help='writes per worker')
+    parser.add_argument('--profiles', nargs='+', default=sorted(PROFILES),
+                        choices=sorted(PROFILES))
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--feeds', type=int, default=1000)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        database = args.database or \
+            'sqlite:///' + os.path.join(tmp, 'bench.sqlite')
+        report = {}
+        for profile in args.profiles:
+            report[profile] = [run(database, profile, tmp, workers, args.ops,
+                                   args.users, args.feeds)
+                               for workers in args.workers]
+        print(json.dumps(report, indent=2, sort_keys=True))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+"""API load benchmark.
+
+Seeds a database with synthetic users, lawyers, feeds, comments, likes and
+messages, then drives the main API routes, with rate limiting turned off,
+through the Flask test client and through a threaded HTTP driver against a
+local server. For each route
+it reports latency percentiles, throughput and the number of SQL
+statements per request, as JSON, so that runs can be compared between
+commits. Run it from the repository root:
+
+    $ python -m bench.load --users 1000 --feeds 2000 --requests 200
+
+A temporary SQLite database is used unless ``--database`` is given, for
+example a scratch Postgres database. Its tables are dropped and created
+again, so never point it at a database holding real data.
+"""
+import argparse
+import base64
+import itertools
+import json
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import create_app, db, search_index
+from app.models import (Comment, Feed, Like, Message, MessageCounter, Role,
+                        User, registry)
+
+WORDS = ('family divorce criminal tax estate property labour immigration '
+         'corporate contract dispute court appeal senior junior partner '
+         'associate counsel advocate notary mediation arbitration patent '
+         'trademark banking insurance maritime energy mining health '
+         'litigation compliance').split()
+CITIES = ('Buea Douala Yaounde Limbe Bamenda Kumba Bafoussam Garoua '
+          'Maroua Bertoua Ebolowa Kribi').split()
+PASSWORD = 'bench'
+ROUTES = ['feeds', 'feed', 'inbox', 'search', 'like', 'login']
+
+
+def text(rnd, n):
+    return ' '.join(rnd.choice(WORDS) for i in range(n))
+
+
+def insert(model, rows, chunk=1000):
+    for i in range(0, len(rows), chunk):
+        db.session.bulk_insert_mappings(model, rows[i:i + chunk])
+    db.session.commit()
+
+
+def seed(args, rnd):
+    """Fill the database, bypassing the ORM unit of work so that large
+    data sets load quickly. Every user shares the same password hash."""
+    user = User()
+    user.set_password(PASSWORD)
+    now = datetime.utcnow()
+    users = []
+    for i in range(1, args.users + args.lawyers + 1):
+        lawyer = i > args.users
+        users.append({
+            'id': i, 'email': 'user%d@example.com' % i,
+            'name': 'user%d %s' % (i, rnd.choice(WORDS)),
+            'password_hash': user.password_hash,
+            'role_id': registry.get_id('Lawyer' if lawyer else 'User'),
+            'company': '%s %s chambers' % (rnd.choice(WORDS),
+                                           rnd.choice(CITIES)),
+            'position': rnd.choice(WORDS), 'location': rnd.choice(CITIES),
+            'about': text(rnd, 20) if lawyer else ''})
+    insert(User, users)
+    n = len(users)
+
+    insert(Feed, [{
+        'id': i, 'title': text(rnd, 4), 'body': text(rnd, 40),
+        'author_id': rnd.randint(1, n),
+        'timestamp': now - timedelta(minutes=args.feeds - i)}
+        for i in range(1, args.feeds + 1)])
+    insert(Comment, [{
+        'body': text(rnd, 10), 'feed_id': rnd.randint(1, args.feeds),
+        'author_id': rnd.randint(1, n)} for i in range(args.comments)])
+    likes = set()
+    while len(likes) < min(args.likes, n * args.feeds):
+        likes.add((rnd.randint(1, n), rnd.randint(1, args.feeds)))
+    insert(Like, [{'user_id': user_id, 'feed_id': feed_id}
+                  for user_id, feed_id in likes])
+    insert(Message, [{
+        'title': text(rnd, 4), 'body': text(rnd, 30),
+        'read': rnd.random() < 0.5, 'sender_id': rnd.randint(1, n),
+        'receiver_id': rnd.randint(1, n),
+        'created_on': now - timedelta(minutes=i)}
+        for i in range(args.messages)])
+
+    Feed.rebuild_counters()
+    MessageCounter.rebuild()
+    search_index.reindex(User)
+    return n
+
+
+def make_requests(args, rnd, nusers, tokens):
+    """Return a list of (route, method, url, body, headers) tuples, in the
+    order they are sent."""
+    requests = []
+    for route in ROUTES:
+        for i in range(args.requests):
+            user_id, token = rnd.choice(tokens)
+            auth = base64.b64encode((token + ':').encode('utf-8'))
+            headers = {'Authorization': 'Basic ' + auth.decode('utf-8')}
+            method, body = 'GET', None
+            if route == 'feeds':
+                url = '/api/feeds'
+            elif route == 'feed':
+                url = '/api/feed/%d' % rnd.randint(1, args.feeds)
+            elif route == 'inbox':
+                url = '/api/inbox'
+            elif route == 'search':
+                method, url = 'POST', '/api/search'
+                body = {'query': rnd.choice(WORDS)}
+            elif route == 'like':
+                url = '/api/like/%d' % rnd.randint(1, args.feeds)
+            else:
+                method, url, headers = 'POST', '/api/login', {}
+                body = {'email': 'user%d@example.com' %
+                                 rnd.randint(1, nusers),
+                        'password': PASSWORD}
+            requests.append((route, method, url, body, headers))
+    return requests
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def summary(times, errors, elapsed, queries):
+    return {'requests': len(times), 'errors': errors,
+            'p50_ms': round(percentile(times, 50) * 1000, 3),
+            'p95_ms': round(percentile(times, 95) * 1000, 3),
+            'p99_ms': round(percentile(times, 99) * 1000, 3),
+            'mean_ms': round(statistics.mean(times) * 1000, 3),
+            'throughput_rps': round(len(times) / elapsed, 1),
+            'queries_per_request': round(queries / len(times), 2)}
+
+
+def run(requests, send, threads, counter):
+    """Send the requests of each route, on ``threads`` threads, and
+    return the summary of each route."""
+    results = {}
+    for route, group in itertools.groupby(requests, key=lambda r: r[0]):
+        group = list(group)
+        counter[0] = 0
+        start = time.perf_counter()
+        with ThreadPoolExecutor(threads) as pool:
+            outcomes = list(pool.map(send, group))
+        elapsed = time.perf_counter() - start
+        times = [latency for latency, ok in outcomes]
+        errors = sum(1 for latency, ok in outcomes if not ok)
+        results[route] = summary(times, errors, elapsed, counter[0])
+    return results
+
+
+def client_driver(app):
+    client = app.test_client()
+
+    def send(request):
+        route, method, url, body, headers = request
+        start = time.perf_counter()
+        rv = client.open(url, method=method, headers=headers, json=body)
+        return time.perf_counter() - start, rv.status_code < 400
+    return send
+
+
+def http_driver(base_url):
+    def send(request):
+        route, method, url, body, headers = request
+        data = None
+        headers = dict(headers)
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        req = urllib.request.Request(base_url + url, data=data,
+                                     headers=headers, method=method)
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(req) as rv:
+                rv.read()
+            ok = True
+        except urllib.error.HTTPError as e:
+            e.read()
+            ok = False
+        return time.perf_counter() - start, ok
+    return send
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', help='database URL, a temporary '
+                        'SQLite database by default')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--lawyers', type=int, default=200)
+    parser.add_argument('--feeds', type=int, default=2000)
+    parser.add_argument('--comments', type=int, default=5000)
+    parser.add_argument('--likes', type=int, default=5000)
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per route')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='concurrent clients of the HTTP driver')
+    parser.add_argument('--tokens', type=int, default=50,
+                        help='number of distinct users sending requests')
+    parser.add_argument('--drivers', nargs='+', default=['client', 'http'],
+                        choices=['client', 'http'])
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        app = create_app('testing')
+        app.config.update(
+            SQLALCHEMY_DATABASE_URI=args.database or
+            'sqlite:///' + os.path.join(tmp, 'bench.sqlite'),
+            SERVER_NAME=None,
+            # the benchmark sends far more requests per user than the
+            # rate limits allow
+            RATELIMIT_ENABLED=False,
+            SEARCH_FTS5_PATH=os.path.join(tmp, 'search-fts5.sqlite'),
+            WHOOSH_INDEX_PATH=os.path.join(tmp, 'search'))
+        search_index.init_app(app, [User, Feed])
+        rnd = random.Random(args.seed)
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            Role.insert_roles()
+            start = time.perf_counter()
+            nusers = seed(args, rnd)
+            seed_time = time.perf_counter() - start
+            tokens = [(user.id, user.generate_auth_token()) for user in
+                      User.query.order_by(User.id).limit(args.tokens)]
+
+            counter = [0]
+            lock = threading.Lock()
+
+            # every engine, so that the reads sent to the replicas and the
+            # other binds are counted too
+            @event.listens_for(Engine, 'before_cursor_execute')
+            def count(*args):
+                with lock:
+                    counter[0] += 1
+
+        report = {'config': dict(vars(args), database=args.database or
+                                 'sqlite'),
+                  'seed_seconds': round(seed_time, 3)}
+        if 'client' in args.drivers:
+            # the test client shares the application globals between
+            # threads, so it sends requests one at a time
+            report['client'] = run(make_requests(args, rnd, nusers, tokens),
+                                   client_driver(app), 1, counter)
+        if 'http' in args.drivers:
+            from werkzeug.serving import make_server
+            server = make_server('127.0.0.1', 0, app,
+                                 threaded=True)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            try:
+                report['http'] = run(
+                    make_requests(args, rnd, nusers, tokens),
+                    http_driver('http://127.0.0.1:%d' % server.port),
+                    args.threads, counter)
+            finally:
+                server.shutdown()
+        print(json.dumps(report, indent=2, sort_keys=True))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""Login throughput benchmark.
+
+Serves the application on a local threaded server and sends
+``/api/login`` requests from N concurrent clients, for every combination
+of client concurrency and password worker count, and reports logins per
+second, latency percentiles and the number of requests turned away with a
+503 by the hashing queue, as JSON. Passwords are hashed with the cost of
+``config/production.py`` unless ``--method`` is given. Run it from the
+repository root:
+
+    $ python -m bench.logins --clients 1 8 32 --workers 1 2 4
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Config
+from werkzeug.serving import make_server
+
+from app import create_app, db, hasher
+from app.models import Role, User
+
+PASSWORD = 'bench'
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def login(url, email):
+    data = json.dumps({'email': email, 'password': PASSWORD}).encode('utf-8')
+    req = urllib.request.Request(url, data=data, method='POST', headers={
+        'Content-Type': 'application/json'})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req) as rv:
+            ok = not json.loads(rv.read().decode('utf-8'))['failed']
+        status = 200 if ok else 401
+    except urllib.error.HTTPError as e:
+        e.read()
+        status = e.code
+    return time.perf_counter() - start, status
+
+
+def run(url, clients, requests, users):
+    emails = ['user%d@example.com' % (i % users) for i in range(requests)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        outcomes = list(pool.map(lambda email: login(url, email), emails))
+    elapsed = time.perf_counter() - start
+    times = [latency for latency, status in outcomes if status == 200]
+    result = {'clients': clients, 'requests': requests,
+              'logins': len(times),
+              'busy': sum(1 for latency, status in outcomes
+                          if status == 503),
+              'errors': sum(1 for latency, status in outcomes
+                            if status not in (200, 503)),
+              'logins_per_second': round(len(times) / elapsed, 1)}
+    if times:
+        result.update({'p50_ms': round(percentile(times, 50) * 1000, 3),
+                       'p95_ms': round(percentile(times, 95) * 1000, 3),
+                       'mean_ms': round(statistics.mean(times) * 1000, 3)})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--requests', type=int, default=64,
+                        help='logins per run')
+    parser.add_argument('--users', type=int, default=16)
+    parser.add_argument('--method', help='password hash method, for '
+                        'example pbkdf2:sha256:150000')
+    args = parser.parse_args()
+
+    production = Config(os.getcwd())
+    production.from_pyfile(os.path.join('config', 'production.py'))
+    tmp = tempfile.mkdtemp()
+    try:
+        app = create_app('testing')
+        app.config.update(
+            SQLALCHEMY_DATABASE_URI='sqlite:///' +
+            os.path.join(tmp, 'bench.sqlite'),
+            SQLALCHEMY_ENGINE_OPTIONS=production['SQLALCHEMY_ENGINE_OPTIONS'],
+            SQLITE_PRAGMAS=production['SQLITE_PRAGMAS'],
+            PASSWORD_HASH_METHOD=args.method or
+            production['PASSWORD_HASH_METHOD'],
+            PASSWORD_QUEUE_SIZE=production['PASSWORD_QUEUE_SIZE'],
+            PASSWORD_QUEUE_TIMEOUT=production['PASSWORD_QUEUE_TIMEOUT'],
+            SERVER_NAME=None,
+            RATELIMIT_ENABLED=False,
+            SEARCH_FTS5_PATH=os.path.join(tmp, 'search-fts5.sqlite'),
+            WHOOSH_INDEX_PATH=os.path.join(tmp, 'search'))
+        hasher.init_app(app)
+        with app.app_context():
+            db.create_all()
+            Role.insert_roles()
+            user = User()
+            user.set_password(PASSWORD)
+            for i in range(args.users):
+                db.session.add(User(email='user%d@example.com' % i,
+                                    name='user%d' % i,
+                                    password_hash=user.password_hash))
+            db.session.commit()
+
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = 'http://127.0.0.1:%d/api/login' % server.port
+        report = {'method': hasher.method, 'cpus': os.cpu_count(),
+                  'runs': []}
+        try:
+            for workers in args.workers:
+                app.config['PASSWORD_WORKERS'] = workers
+                hasher.init_app(app)
+                for clients in args.clients:
+                    result = run(url, clients, args.requests, args.users)
+                    result['workers'] = workers
+                    report['runs'].append(result)
+        finally:
+            server.shutdown()
+        print(json.dumps(report, indent=2, sort_keys=True))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""Search engine benchmark.
+
+Indexes synthetic users with each search engine and reports indexing
+throughput and query latency, for lawyer searches (filtered on role_id)
+that return the first page of 25 hits. Run it from the repository root:
+
+    $ python -m bench.search --sizes 10000 100000 --engines fts5 whoosh
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+
+from app.search import get_engine_class
+
+FIELDS = ['name', 'company', 'email', 'position', 'location', 'about']
+FILTERS = ['role_id']
+WORDS = ('family divorce criminal tax estate property labour immigration '
+         'corporate contract dispute court appeal senior junior partner '
+         'associate counsel advocate notary mediation arbitration patent '
+         'trademark banking insurance maritime energy mining health '
+         'litigation compliance').split()
+CITIES = ('Buea Douala Yaounde Limbe Bamenda Kumba Bafoussam Garoua '
+          'Maroua Bertoua Ebolowa Kribi').split()
+
+# free text is drawn from a larger vocabulary with a Zipf-like
+# distribution, so that common words match many users and rare ones few
+VOCABULARY = WORDS + ['term%d' % i for i in range(2000)]
+WEIGHTS = [1.0 / (rank + 1) for rank in range(len(VOCABULARY))]
+
+
+def make_docs(n, seed=42):
+    rnd = random.Random(seed)
+    for i in range(1, n + 1):
+        yield {
+            'id': i,
+            'name': 'user%d %s' % (i, rnd.choice(WORDS)),
+            'company': '%s %s chambers' % (rnd.choice(WORDS),
+                                           rnd.choice(CITIES)),
+            'email': 'user%d@example.com' % i,
+            'position': rnd.choice(WORDS),
+            'location': rnd.choice(CITIES),
+            'about': ' '.join(rnd.choices(VOCABULARY, WEIGHTS, k=20)),
+            'role_id': 2 if rnd.random() < 0.3 else 1,
+        }
+
+
+def make_engine(name, tmp):
+    cls = get_engine_class(name)
+    if name == 'fts5':
+        return cls(os.path.join(tmp, 'search.sqlite'), 'users', FIELDS,
+                   FILTERS)
+    return cls(tmp, 'users', FIELDS, FILTERS)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def run(engine_name, size, queries, batch):
+    tmp = tempfile.mkdtemp()
+    try:
+        engine = make_engine(engine_name, tmp)
+
+        # index the documents in batches, as session commits would
+        start = time.perf_counter()
+        docs = []
+        for doc in make_docs(size):
+            docs.append(doc)
+            if len(docs) == batch:
+                engine.update(docs)
+                docs = []
+        if docs:
+            engine.update(docs)
+        elapsed = time.perf_counter() - start
+
+        # run lawyer searches with one and two words, and with prefixes
+        rnd = random.Random(7)
+        times = []
+        for i in range(queries):
+            words = rnd.choices(VOCABULARY, WEIGHTS, k=rnd.choice([1, 2]))
+            if i % 4 == 0:
+                words[-1] = words[-1][:3] + '*'
+            start = time.perf_counter()
+            engine.search(' '.join(words), {'role_id': 2}, 1, 25)
+            times.append(time.perf_counter() - start)
+        return {
+            'engine': engine_name,
+            'users': size,
+            'index_seconds': round(elapsed, 3),
+            'index_docs_per_second': round(size / elapsed, 1),
+            'query_p50_ms': round(statistics.median(times) * 1000, 3),
+            'query_p95_ms': round(percentile(times, 95) * 1000, 3),
+            'query_mean_ms': round(statistics.mean(times) * 1000, 3),
+        }
+    finally:
+        shutil.rmtree(tmp)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 100000])
+    parser.add_argument('--engines', nargs='+', default=['fts5', 'whoosh'])
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--batch', type=int, default=1000)
+    args = parser.parse_args()
+    results = [run(engine, size, args.queries, args.batch)
+               for size in args.sizes for engine in args.engines]
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
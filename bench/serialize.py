@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""JSON encoding micro-benchmark.
+
+Turns a page of feeds into a JSON response, the way the feeds routes do,
+and reports the best time of several rounds, split into building the
+dictionaries and encoding them, for every available encoder. The
+``reference`` row builds the dictionaries with one ``url_for`` call per
+URL and leaves the dates to Flask's ``jsonify``, as the models did before
+the serializers were compiled. Run it from the repository root:
+
+    $ python -m bench.serialize --feeds 1000 --rounds 20
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from flask import g, jsonify as flask_jsonify, url_for
+
+from app import create_app, db, encoder
+from app.encoding import ENCODERS
+from app.models import Feed, Role, User, load_users
+
+
+def reference_feed(feed, author):
+    def image(filename):
+        if filename is None:
+            return 'false'
+        return url_for('static', filename=filename, _external=True)
+    feed_image = feed.image and 'images/feeds/' + feed.image
+    author_image = author.image and 'images/users/' + author.image
+    return {
+        'id': feed.id,
+        'likes': feed.like_count,
+        'comments': feed.comment_count,
+        'self_url': url_for('api.get_feed', id=feed.id, _external=True),
+        'author_id': author.id,
+        'author_name': author.name,
+        'author_image': image(author_image),
+        'author_thumbnail': image(author_image),
+        'author_company': author.company,
+        'author_position': author.position,
+        'title': feed.title,
+        'body': feed.body,
+        'created_on': feed.timestamp,
+        'image': image(feed_image),
+        'image_thumbnail': image(feed_image),
+        'image_medium': image(feed_image),
+        'comments_url': url_for('api.get_feed_comments', id=feed.id,
+                                _external=True)
+    }
+
+
+def reference(feeds):
+    authors = load_users(feed.author_id for feed in feeds)
+    return [reference_feed(feed, authors.get(feed.author_id))
+            for feed in feeds]
+
+
+def compiled(feeds):
+    # every response starts from a new request, with no URL templates
+    g.pop('urls', None)
+    return Feed.export_collection(feeds)
+
+
+def measure(feeds, export, jsonify, rounds):
+    export_time = encode_time = None
+    for i in range(rounds):
+        start = time.perf_counter()
+        data = export(feeds)
+        middle = time.perf_counter()
+        body = jsonify({'feeds': data}).get_data()
+        end = time.perf_counter()
+        if export_time is None or middle - start < export_time:
+            export_time = middle - start
+        if encode_time is None or end - middle < encode_time:
+            encode_time = end - middle
+    return {'export_ms': round(export_time * 1000, 3),
+            'encode_ms': round(encode_time * 1000, 3),
+            'total_ms': round((export_time + encode_time) * 1000, 3),
+            'bytes': len(body)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--feeds', type=int, default=1000)
+    parser.add_argument('--authors', type=int, default=100)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        app = create_app('testing')
+        app.config.update(
+            SQLALCHEMY_DATABASE_URI='sqlite:///' +
+            os.path.join(tmp, 'bench.sqlite'),
+            SERVER_NAME=None,
+            SEARCH_FTS5_PATH=os.path.join(tmp, 'search-fts5.sqlite'),
+            WHOOSH_INDEX_PATH=os.path.join(tmp, 'search'))
+        with app.app_context():
+            db.create_all()
+            Role.insert_roles()
+            db.session.bulk_insert_mappings(User, [
+                {'id': i, 'email': 'user%d@example.com' % i,
+                 'name': 'user %d' % i, 'company': 'company %d' % i,
+                 'position': 'partner', 'image': 'user%d.jpg' % i}
+                for i in range(1, args.authors + 1)])
+            db.session.bulk_insert_mappings(Feed, [
+                {'id': i, 'title': 'feed %d' % i, 'body': 'body ' * 40,
+                 'author_id': i % args.authors + 1,
+                 'image': 'feed%d.jpg' % i if i % 2 else None}
+                for i in range(1, args.feeds + 1)])
+            db.session.commit()
+            feeds = Feed.query.order_by(Feed.id).all()
+
+            report = {'feeds': args.feeds, 'rounds': args.rounds}
+            with app.test_request_context('/api/feeds'):
+                report['reference'] = measure(feeds, reference,
+                                              flask_jsonify, args.rounds)
+                expected = json.loads(flask_jsonify(
+                    {'feeds': compiled(feeds)}).get_data())
+                for name in sorted(ENCODERS):
+                    app.config['JSON_ENCODER'] = name
+                    try:
+                        encoder.init_app(app)
+                    except ImportError:
+                        report[name] = None
+                        continue
+                    report[name] = measure(feeds, compiled,
+                                           encoder.response, args.rounds)
+                    body = encoder.response({'feeds': compiled(feeds)})
+                    assert json.loads(body.get_data()) == expected
+        print(json.dumps(report, indent=2, sort_keys=True))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""Startup and upload latency benchmark.
+
+Measures the cold import time of the application (a fresh interpreter
+importing ``run``) and the latency of ``/api/upload_user_photo`` through the
+Flask test client. Run it from the repository root:
+
+    $ python -m bench.startup --imports 5 --uploads 50
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def cold_import(runs):
+    """Return the wall time in seconds of importing the app in a fresh
+    interpreter, once per run."""
+    times = []
+    for i in range(runs):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, '-c', 'import run'],
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def upload_latency(runs):
+    """Return the latency in seconds of uploading a user photo, once per
+    run."""
+    from app import create_app, db
+    from app.models import User, Role
+
+    tmp = tempfile.mkdtemp()
+    try:
+        app = create_app('testing')
+        app.config['SQLALCHEMY_DATABASE_URI'] = \
+            'sqlite:///' + os.path.join(tmp, 'bench.sqlite')
+        app.config['USER_UPLOAD_FOLDER'] = tmp
+        app.config['RATELIMIT_ENABLED'] = False
+        app.config['WHOOSH_INDEX_PATH'] = os.path.join(tmp, 'index')
+        with app.app_context():
+            db.create_all()
+            Role.insert_roles()
+            user = User(name='bench', email='bench@example.com')
+            user.set_password('bench')
+            db.session.add(user)
+            db.session.commit()
+            token = user.generate_auth_token()
+        auth = base64.b64encode((token + ':').encode('utf-8')).decode('utf-8')
+        headers = {'Authorization': 'Basic ' + auth}
+        client = app.test_client()
+        image = b'\x89PNG\r\n\x1a\n' + b'\x00' * 64 * 1024
+
+        times = []
+        for i in range(runs):
+            data = {'image': (io.BytesIO(image), 'photo.png')}
+            start = time.perf_counter()
+            rv = client.post('/api/upload_user_photo', data=data,
+                             headers=headers,
+                             content_type='multipart/form-data')
+            times.append(time.perf_counter() - start)
+            assert rv.status_code == 200, rv.status_code
+        return times
+    finally:
+        shutil.rmtree(tmp)
+
+
+def summary(times):
+    return {'runs': len(times),
+            'mean_ms': round(statistics.mean(times) * 1000, 3),
+            'median_ms': round(statistics.median(times) * 1000, 3),
+            'max_ms': round(max(times) * 1000, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--imports', type=int, default=5)
+    parser.add_argument('--uploads', type=int, default=50)
+    args = parser.parse_args()
+    print(json.dumps({'cold_import': summary(cold_import(args.imports)),
+                      'upload': summary(upload_latency(args.uploads))},
+                     indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
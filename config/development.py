@@ -8,5 +8,35 @@ DEBUG = True
 IGNORE_AUTH = True
 SECRET_KEY = 'top-secret!'
 UPLOAD_FOLDER = os.path.join(basedir, '../app/static/images')
+USER_UPLOAD_FOLDER = os.path.join(basedir, '../app/static/images/users')
+FEED_UPLOAD_FOLDER = os.path.join(basedir, '../app/static/images/feeds')
 SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///' + db_path
+SQLALCHEMY_ENGINE_OPTIONS = {
+    'pool_size': 10,
+    'max_overflow': 20,
+    'pool_pre_ping': True,
+    'pool_recycle': 1800,
+}
+SQLALCHEMY_REPLICAS = os.environ.get('DATABASE_REPLICA_URLS', '').split()
+SQLALCHEMY_REPLICA_WINDOW = 5
+SQLALCHEMY_REPLICA_PIN_STORE = 'mmap'
+SQLALCHEMY_REPLICA_PIN_STORE_PATH = os.path.join(basedir, '../replica-pins.mmap')
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+}
+SEARCH_ENGINE = 'fts5'
+SEARCH_FTS5_PATH = os.path.join(basedir, 'search-fts5.sqlite')
+DB_INSTRUMENTATION = bool(os.environ.get('DB_INSTRUMENTATION'))
+DB_SLOW_QUERY_THRESHOLD = 0.5
+RATELIMIT_DEFAULT = (20, 15)
+RATELIMIT_ENDPOINTS = {'api.login': (10, 60)}
+RATELIMIT_STORE = 'mmap'
+RATELIMIT_STORE_PATH = os.path.join(basedir, '../ratelimit.mmap')
+PASSWORD_HASH_METHOD = 'pbkdf2:sha256:150000'
+PASSWORD_WORKERS = 2
+PASSWORD_QUEUE_SIZE = 64
+PASSWORD_QUEUE_TIMEOUT = 5
+JSON_ENCODER = 'auto'
 WHOOSH_INDEX_PATH = os.path.join(basedir, 'search.sqlite')
@@ -8,5 +8,10 @@ TESTING = True
 SECRET_KEY = 'top-secret!'
 SERVER_NAME = 'example.com'
 UPLOAD_FOLDER = os.path.join(basedir, '../app/static/images')
+USER_UPLOAD_FOLDER = os.path.join(basedir, '../app/static/images/users')
+FEED_UPLOAD_FOLDER = os.path.join(basedir, '../app/static/images/feeds')
 SQLALCHEMY_DATABASE_URI = 'sqlite:///' + db_path
+SEARCH_ENGINE = 'fts5'
+SEARCH_FTS5_PATH = os.path.join(basedir, 'search-fts5.sqlite')
+PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
 WHOOSH_INDEX_PATH = os.path.join(basedir, 'search.sqlite')
@@ -1,8 +1,13 @@
 __author__ = 'CRUCIFIX'
 
+import sqlite3
+import time
+
 
 from run import app
-from app import db
+from app import db, image_store, search_index
+from app.bulk import IMPORTABLE, BulkImporter, read_rows
+from app.models import Feed, MessageCounter, Role, User
 from flask_script import Manager, prompt_bool
 from flask_migrate import Migrate, MigrateCommand
 
@@ -14,6 +19,7 @@ migrate = Migrate(app, db)
 def initdb():
 	print('Initialising database')
 	db.create_all()
+	Role.insert_roles()
 
 @manager.command
 def dropdb():
@@ -21,6 +27,76 @@ def dropdb():
         print('Droping database')
         db.drop_all()
 
+@manager.command
+def rebuild_counters():
+    """Recompute the feed and message counters from scratch."""
+    print('Rebuilding feed counters')
+    Feed.rebuild_counters()
+    print('Rebuilding message counters')
+    MessageCounter.rebuild()
+
+@manager.command
+def make_variants():
+    """Create the resized variants of the images stored without them."""
+    for name in ('USER_UPLOAD_FOLDER', 'FEED_UPLOAD_FOLDER'):
+        folder = app.config[name]
+        print('Resizing images in %s' % folder)
+        print('Added variants to %d images' % image_store.add_variants(folder))
+
+@manager.option('-c', '--chunk-size', dest='chunk_size', type=int, default=1000,
+                help='number of rows read from the database at a time')
+@manager.option('-p', '--procs', dest='procs', type=int, default=1,
+                help='number of index writer processes, when supported')
+def reindex(chunk_size, procs):
+    """Rebuild the search index of every searchable model."""
+    for model in (User, Feed):
+        print('Reindexing %s' % model.__tablename__)
+        start = time.time()
+        rows = search_index.reindex(model, chunk_size=chunk_size, procs=procs)
+        elapsed = time.time() - start
+        print('Indexed %d rows in %.1f seconds (%.0f rows/s)' %
+              (rows, elapsed, rows / elapsed if elapsed else 0))
+
+@manager.option('path', help='NDJSON or CSV file to import')
+@manager.option('-t', '--table', dest='table', default='users',
+                help='table to import into: ' + ', '.join(sorted(IMPORTABLE)))
+@manager.option('-f', '--format', dest='format', choices=['ndjson', 'csv'],
+                help='file format, guessed from the extension by default')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=1000,
+                help='number of rows inserted at a time')
+@manager.option('-p', '--procs', dest='procs', type=int, default=None,
+                help='number of password hashing processes')
+def bulk_import(path, table, format, batch_size, procs):
+    """Import rows from an NDJSON or CSV file."""
+    importer = BulkImporter(IMPORTABLE[table], batch_size=batch_size,
+                            procs=procs)
+    start = time.time()
+    rows = importer.run(read_rows(path, format))
+    elapsed = time.time() - start
+    print('Imported %d rows in %.1f seconds (%.0f rows/s)' %
+          (rows, elapsed, rows / elapsed if elapsed else 0))
+
+@manager.command
+def sync_replicas():
+    """Copy an SQLite primary database over its SQLite replicas, to try
+    read replica routing locally."""
+    primary = db.engine.url
+    if primary.drivername != 'sqlite':
+        print('The primary database is not an SQLite file')
+        return
+    source = sqlite3.connect(primary.database)
+    replicas = app.extensions.get('db_replicas')
+    for key in (replicas.keys if replicas is not None else []):
+        url = db.get_engine(app, bind=key).url
+        if url.drivername != 'sqlite':
+            print('Skipping %s, not an SQLite file' % key)
+            continue
+        print('Copying %s to %s' % (primary.database, url.database))
+        target = sqlite3.connect(url.database)
+        source.backup(target)
+        target.close()
+    source.close()
+
 manager.add_command('db', MigrateCommand)
 
 if __name__ == '__main__':
@@ -0,0 +1,123 @@
+import base64
+import unittest
+from sqlalchemy import event
+from app import create_app, db
+from app.models import Comment, Feed, Like, Role, User, _token_cache, \
+    _user_cache
+
+
+class PaginateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['RATELIMIT_ENABLED'] = False
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.drop_all()
+        db.create_all()
+        Role.insert_roles()
+        _token_cache.clear()
+        _user_cache.clear()
+
+        users = []
+        for i in range(5):
+            user = User(name='user%d' % i, email='user%d@example.com' % i)
+            user.set_password('cat')
+            db.session.add(user)
+            users.append(user)
+        db.session.commit()
+        for i in range(60):
+            feed = Feed(title='feed %d' % i, body='body',
+                        author=users[i % len(users)])
+            db.session.add(feed)
+            db.session.add(Like(feed=feed, liker=users[i % 2]))
+            db.session.add(Comment(body='comment', feed=feed,
+                                   author=users[i % 3]))
+        db.session.commit()
+        Feed.rebuild_counters()
+        token = users[0].generate_auth_token()
+        db.session.remove()
+
+        self.headers = {'Authorization': 'Basic ' + base64.b64encode(
+            (token + ':').encode('utf-8')).decode('utf-8')}
+        self.client = self.app.test_client()
+        self.statements = []
+        event.listen(db.engine, 'before_cursor_execute', self.count)
+
+    def tearDown(self):
+        event.remove(db.engine, 'before_cursor_execute', self.count)
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def count(self, conn, cursor, statement, parameters, context,
+              executemany):
+        self.statements.append(statement)
+
+    def get(self, url):
+        del self.statements[:]
+        rv = self.client.get(url, headers=self.headers)
+        self.assertEqual(rv.status_code, 200)
+        return rv, len(self.statements)
+
+    def test_feeds_query_count(self):
+        # the first request also loads the authenticated user, which is
+        # then served from the snapshot cache
+        rv, cold = self.get('/api/feeds?per_page=5')
+        self.assertEqual(len(rv.get_json()['feeds']), 5)
+
+        # version, page, count and authors, whatever the page size
+        counts = {}
+        for per_page in (5, 25):
+            rv, counts[per_page] = self.get('/api/feeds?page=2&per_page=%d'
+                                            % per_page)
+            self.assertEqual(len(rv.get_json()['feeds']), per_page)
+        self.assertEqual(counts[5], counts[25])
+        self.assertEqual(counts[25], 4)
+        self.assertEqual(cold, counts[25] + 1)
+
+    def test_feeds_cursor_query_count(self):
+        self.get('/api/feeds?cursor=&per_page=1')
+
+        # version, page and authors, with no count
+        counts = {}
+        for per_page in (5, 25):
+            rv, counts[per_page] = self.get('/api/feeds?cursor=&per_page=%d'
+                                            % per_page)
+            self.assertEqual(len(rv.get_json()['feeds']), per_page)
+        self.assertEqual(counts[5], counts[25])
+        self.assertEqual(counts[25], 3)
+
+    def test_feeds_export(self):
+        rv, count = self.get('/api/feeds?per_page=25')
+        for item in rv.get_json()['feeds']:
+            feed = Feed.query.get(item['id'])
+            self.assertEqual(item['likes'], feed.likes.count())
+            self.assertEqual(item['comments'], feed.comments.count())
+            self.assertEqual(item['author_id'], feed.author_id)
+            self.assertEqual(item['author_name'], feed.author.name)
+
+    def test_user_feeds_default_to_cursor(self):
+        self.get('/api/user/1/feeds?per_page=1')
+
+        # version, page and authors, with no count
+        rv, count = self.get('/api/user/1/feeds?per_page=10')
+        pages = rv.get_json()['pages']
+        self.assertIn('next_cursor', pages)
+        self.assertNotIn('total', pages)
+        self.assertEqual(count, 3)
+        self.assertFalse([statement for statement in self.statements
+                          if 'count(' in statement.lower()])
+
+        # the next page follows the cursor of the first one
+        next_url = pages['next_url'].replace('http://example.com', '')
+        rv, count = self.get(next_url)
+        ids = [item['id'] for item in rv.get_json()['feeds']]
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(count, 3)
+
+    def test_per_page_is_at_least_one(self):
+        for per_page in (0, -5):
+            rv, count = self.get('/api/user/1/feeds?per_page=%d' % per_page)
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(len(rv.get_json()['feeds']), 1)
+            self.assertEqual(rv.get_json()['pages']['per_page'], 1)